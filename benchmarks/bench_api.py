@@ -0,0 +1,438 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Latency and throughput benchmark of the operator API.
+
+Requests go through the Flask app in process, no cluster nor network needed.
+The data store is replaced by in-memory datasets built like the test mocks
+(--backend mock, default), or is a local PostgreSQL seeded with --jobs rows
+(--backend postgres, configured with the POSTGRES_* env vars). Results
+downloaded by /getResult always come from an in-memory storage.
+
+    python benchmarks/bench_api.py --jobs 100000 --requests 2000 --concurrency 16
+    python benchmarks/bench_api.py --save benchmarks/baseline.json
+    python benchmarks/bench_api.py --compare benchmarks/baseline.json
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+import kubernetes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# admin routes load the in-cluster config on import, there is none here
+kubernetes.config.load_incluster_config = lambda: None
+
+import operator_service.routes  # noqa: E402
+import operator_service.utils  # noqa: E402
+from operator_service.constants import BaseURLs  # noqa: E402
+from operator_service.run import app  # noqa: E402
+from test.operator_payloads import VALID_COMPUTE_BODY, VALID_WALLET  # noqa: E402
+from test.utils import sign_message  # noqa: E402
+
+SCENARIOS = [
+    "post_compute",
+    "get_compute",
+    "running_jobs",
+    "environments",
+    "get_result",
+]
+CHAIN_ID = "8996"
+BASE_TIMESTAMP = 1700000000
+STORAGE_URL = "https://storage.bench/result.txt"
+OWNERS_COUNT = 100
+
+
+def get_owner(index):
+    return f"0x{index + 1:040x}"
+
+
+def get_job_id(index):
+    return f"{index:032x}"
+
+
+class Dataset:
+    """
+    In-memory replacement of the data_store functions used by the routes.
+    Jobs are built on the fly, like rows streamed from a cursor.
+    """
+
+    def __init__(self, jobs, environments):
+        self.jobs = jobs
+        self.environments = environments
+
+    def make_job(self, index):
+        running = index % 10 == 0
+        return {
+            "agreementId": f"bench-{index}",
+            "jobId": get_job_id(index),
+            "owner": get_owner(index % OWNERS_COUNT),
+            "status": 40 if running else 70,
+            "statusText": "Running algorithm" if running else "Job finished",
+            # data_store returns epochs as strings
+            "dateCreated": f"{BASE_TIMESTAMP + index}.123456",
+            "dateFinished": (
+                None if running else f"{BASE_TIMESTAMP + index + 60}.123456"
+            ),
+            "results": [{"filename": "result.txt", "filesize": 1024, "type": "output"}],
+            "stopreq": 0,
+            "removed": 0,
+            "algoDID": "did:op:algo",
+            "inputDID": ["did:op:input"],
+        }
+
+    def iter_sql_status(
+        self, agreement_id, job_id, owner, chain_id, limit=None, after=None
+    ):
+        if job_id is not None:
+            indexes = [int(job_id, 16)]
+        else:
+            owner_index = int(owner, 16) - 1
+            indexes = range(owner_index, self.jobs, OWNERS_COUNT)
+        for index in itertools.islice(indexes, limit):
+            yield self.make_job(index)
+
+    def get_sql_status(self, agreement_id, job_id, owner, chain_id):
+        return list(self.iter_sql_status(agreement_id, job_id, owner, chain_id))
+
+    def iter_sql_running_jobs(self, limit=None, after=None):
+        for index in itertools.islice(range(0, self.jobs, 10), limit):
+            yield self.make_job(index)
+
+    def get_cached_environments(self, chain_id):
+        return [
+            {
+                "id": f"bench-env-{i}",
+                "cpuNumber": 1,
+                "ramGB": 1,
+                "diskGB": 1,
+                "priceMin": 0,
+                "maxJobs": 10,
+                "allowedChainId": [],
+                "lastSeen": str(BASE_TIMESTAMP),
+            }
+            for i in range(self.environments)
+        ]
+
+    def get_sql_job_urls(self, job_id):
+        index = int(job_id, 16)
+        return [{"url": STORAGE_URL}], get_owner(index % OWNERS_COUNT)
+
+    def install(self):
+        routes = operator_service.routes
+        routes.is_agreement_id_in_use = lambda agreement_id: False
+        routes.check_environment_exists = lambda environment, chain_id: True
+        routes.create_sql_job = lambda *args: self.make_job(0)
+        routes.get_sql_status = self.get_sql_status
+        routes.iter_sql_status = self.iter_sql_status
+        routes.iter_sql_running_jobs = self.iter_sql_running_jobs
+        routes.get_cached_environments = self.get_cached_environments
+        # the dataset never changes, ETags are computed but never match
+        routes.get_sql_status_fingerprint = lambda *args: (self.jobs, BASE_TIMESTAMP)
+        routes.get_sql_running_jobs_fingerprint = lambda: (self.jobs, BASE_TIMESTAMP)
+        routes.get_cached_environments_fingerprint = lambda: (
+            self.environments,
+            BASE_TIMESTAMP,
+        )
+        routes.get_sql_job_urls = self.get_sql_job_urls
+        routes.get_job_by_provider_and_owner = lambda owner, provider: [owner]
+        operator_service.utils.update_nonce_for_a_certain_provider = (
+            lambda nonce, provider_address: True
+        )
+
+
+def seed_postgres(jobs, environments):
+    from operator_service import data_store
+
+    client = app.test_client()
+    os.environ.setdefault("ALLOWED_ADMINS", '["bench"]')
+    admin = json.loads(os.environ["ALLOWED_ADMINS"])[0]
+    client.post(f"{BaseURLs.BASE_OPERATOR_URL}/pgsqlinit", headers={"Admin": admin})
+    cleanup_postgres()
+
+    env_status = json.dumps({"cpuNumber": 1, "ramGB": 1, "allowedChainId": []})
+    for i in range(environments):
+        data_store._execute_query(
+            "INSERT INTO envs(namespace, status, lastping) VALUES(%(env)s, %(status)s, NOW())",
+            {"env": f"bench-env-{i}", "status": env_status},
+            "bench_seed_envs",
+        )
+    outputs = json.dumps([{"filename": "result.txt", "url": STORAGE_URL}])
+    data_store._execute_query(
+        """
+        INSERT INTO jobs (agreementId, workflowId, owner, status, statusText,
+            dateCreated, dateFinished, outputsURL, namespace, workflow, provider,
+            chainId, algoDID, inputDIDs)
+        SELECT 'bench-' || i, lpad(to_hex(i), 32, '0'),
+            '0x' || lpad(to_hex(i %% %(owners)s + 1), 40, '0'),
+            CASE WHEN i %% 10 = 0 THEN 40 ELSE 70 END,
+            CASE WHEN i %% 10 = 0 THEN 'Running algorithm' ELSE 'Job finished' END,
+            to_timestamp(%(base)s + i) AT TIME ZONE 'UTC',
+            CASE WHEN i %% 10 = 0 THEN NULL
+                ELSE to_timestamp(%(base)s + i + 60) AT TIME ZONE 'UTC' END,
+            %(outputs)s, 'bench-env-0', '{}', %(provider)s,
+            %(chainId)s, 'did:op:algo', ARRAY['did:op:input']
+        FROM generate_series(0, %(jobs)s - 1) AS i
+        """,
+        {
+            "owners": OWNERS_COUNT,
+            "base": BASE_TIMESTAMP,
+            "outputs": outputs,
+            "provider": VALID_WALLET.address,
+            "chainId": CHAIN_ID,
+            "jobs": jobs,
+        },
+        "bench_seed_jobs",
+    )
+    data_store._execute_query("ANALYZE jobs", {}, "bench_analyze")
+
+    # concurrent requests can send their nonces out of order, a rejected nonce
+    # still did the database round trip being measured
+    update_nonce = operator_service.utils.update_nonce_for_a_certain_provider
+    operator_service.utils.update_nonce_for_a_certain_provider = (
+        lambda nonce, provider_address: update_nonce(nonce, provider_address)
+        is not None
+    )
+
+
+def cleanup_postgres():
+    from operator_service import data_store
+
+    data_store._execute_query(
+        "DELETE FROM jobs WHERE agreementId LIKE 'bench-%%'", {}, "bench_cleanup"
+    )
+    data_store._execute_query(
+        "DELETE FROM envs WHERE namespace LIKE 'bench-%%'", {}, "bench_cleanup"
+    )
+
+
+class FakeStorageResponse:
+    def __init__(self, size):
+        self.size = size
+        self.status_code = 200
+        self.headers = {"Content-Length": str(size), "Content-Type": "text/plain"}
+        self.raw = self
+
+    def stream(self, chunk_size, decode_content=True):
+        chunk = b"x" * chunk_size
+        remaining = self.size
+        while remaining > 0:
+            yield chunk[:remaining]
+            remaining -= chunk_size
+
+    def close(self):
+        pass
+
+
+class FakeStorageSession:
+    def __init__(self, size):
+        self.size = size
+
+    def get(self, url, **kwargs):
+        return FakeStorageResponse(self.size)
+
+
+class Requests:
+    """
+    Builds the requests of each scenario, signatures are computed once.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.nonces = itertools.count(time.time_ns())
+        self.signatures = dict()
+        self.sequence = itertools.count()
+
+    def sign(self, message):
+        if message not in self.signatures:
+            self.signatures[message] = sign_message(message, VALID_WALLET)
+        return self.signatures[message]
+
+    def next_index(self):
+        return next(self.sequence) % self.args.jobs
+
+    def post_compute(self, client):
+        body = deepcopy(VALID_COMPUTE_BODY)
+        body["agreementId"] = f"bench-post-{uuid.uuid4().hex}"
+        body["environment"] = "bench-env-0"
+        body["chainId"] = CHAIN_ID
+        body["providerSignature"] = self.sign(body["owner"])
+        body["nonce"] = next(self.nonces)
+        return client.post(f"{BaseURLs.BASE_OPERATOR_URL}/compute", json=body)
+
+    def get_compute(self, client):
+        owner = get_owner(self.next_index() % OWNERS_COUNT)
+        params = {
+            "owner": owner,
+            "chainId": CHAIN_ID,
+            "providerSignature": self.sign(owner),
+            "nonce": next(self.nonces),
+        }
+        if self.args.limit:
+            params["limit"] = self.args.limit
+        return client.get(f"{BaseURLs.BASE_OPERATOR_URL}/compute", query_string=params)
+
+    def running_jobs(self, client):
+        params = {"limit": self.args.limit} if self.args.limit else None
+        return client.get(
+            f"{BaseURLs.BASE_OPERATOR_URL}/runningjobs", query_string=params
+        )
+
+    def environments(self, client):
+        return client.get(
+            f"{BaseURLs.BASE_OPERATOR_URL}/environments",
+            query_string={"chainId": CHAIN_ID},
+        )
+
+    def get_result(self, client):
+        index = self.next_index()
+        owner = get_owner(index % OWNERS_COUNT)
+        job_id = get_job_id(index)
+        params = {
+            "index": 0,
+            "jobId": job_id,
+            "owner": owner,
+            "providerSignature": self.sign(f"{owner}{job_id}"),
+            "nonce": next(self.nonces),
+        }
+        return client.get(
+            f"{BaseURLs.BASE_OPERATOR_URL}/getResult", query_string=params
+        )
+
+
+def percentile(latencies, q):
+    return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+
+def run_scenario(name, requests, args):
+    send = getattr(requests, name)
+    local = threading.local()
+    latencies = []
+    errors = []
+
+    def _send(record):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        start = time.perf_counter()
+        response = send(local.client)
+        # streamed bodies are part of the latency
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        if record:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(lambda _: _send(False), range(args.warmup)))
+        start = time.perf_counter()
+        list(executor.map(lambda _: _send(True), range(args.requests)))
+        duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "rps": round(len(latencies) / duration, 1),
+        "errors": len(errors),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of regressions, a metric is worse than the baseline by more
+    than tolerance (0.2 is 20%)
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        for metric in ["p50_ms", "p99_ms"]:
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name} {metric}: {base[metric]} -> {result[metric]}"
+                )
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name} rps: {base['rps']} -> {result['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backend", choices=["mock", "postgres"], default="mock")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--jobs", type=int, default=10000, help="jobs in the dataset")
+    parser.add_argument("--environments", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=1000, help="per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--limit", type=int, default=100, help="page size of job lists, 0 for all"
+    )
+    parser.add_argument(
+        "--result-size", type=int, default=1024 * 1024, help="bytes per /getResult"
+    )
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--compare", help="baseline file to compare the results to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep-data", action="store_true", help="postgres backend")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    os.environ["ALLOWED_PROVIDERS"] = json.dumps([VALID_WALLET.address])
+    app.testing = True
+    operator_service.routes.get_requests_session = lambda: FakeStorageSession(
+        args.result_size
+    )
+    if args.backend == "mock":
+        Dataset(args.jobs, args.environments).install()
+    else:
+        seed_postgres(args.jobs, args.environments)
+
+    requests = Requests(args)
+    results = dict()
+    try:
+        for name in args.scenarios.split(","):
+            results[name] = run_scenario(name, requests, args)
+            result = results[name]
+            print(
+                f"{name:<14} p50 {result['p50_ms']:>9.3f} ms  p99 {result['p99_ms']:>9.3f} ms"
+                f"  {result['rps']:>9.1f} req/s  errors {result['errors']}"
+            )
+    finally:
+        if args.backend == "postgres" and not args.keep_data:
+            cleanup_postgres()
+
+    settings = {
+        key: getattr(args, key)
+        for key in ["backend", "jobs", "concurrency", "limit", "result_size"]
+    }
+    if args.save:
+        with open(args.save, "wt") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare, "rt") as f:
+            baseline = json.load(f)
+        if baseline["settings"] != settings:
+            print(f"Warning: baseline settings differ: {baseline['settings']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,5 +3,11 @@
 export CONFIG_FILE=/operator-service/config.ini
 envsubst < /operator-service/config.ini.template > /operator-service/config.ini
 
-gunicorn -b ${OPERATOR_URL#*://} -w ${OPERATOR_WORKERS} -t ${OPERATOR_TIMEOUT} operator_service.run:app
+# metrics of previous runs must not be aggregated with the new workers
+if [ -n "${PROMETHEUS_MULTIPROC_DIR}" ]; then
+  rm -rf "${PROMETHEUS_MULTIPROC_DIR}"
+  mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+fi
+
+gunicorn -b ${OPERATOR_URL#*://} -w ${OPERATOR_WORKERS} -t ${OPERATOR_TIMEOUT} -k ${OPERATOR_WORKER_CLASS:-sync} operator_service.run:app
 tail -f /dev/null
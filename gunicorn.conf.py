@@ -0,0 +1,15 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+# loaded by gunicorn from the working directory, on top of the command line
+# options of docker-entrypoint.sh
+
+from operator_service.green import get_worker_connections
+
+worker_connections = get_worker_connections()
+
+
+def child_exit(server, worker):
+    from operator_service.metrics import child_exit
+
+    child_exit(server, worker)
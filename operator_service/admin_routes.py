@@ -8,6 +8,7 @@ from flask_headers import headers
 
 from operator_service.config import Config
 from operator_service.kubernetes_api import KubeAPI
+from operator_service.migrations import run_migrations
 from operator_service.utils import check_admin
 
 adminpg_services = Blueprint("adminpg_services", __name__)
@@ -106,8 +107,8 @@ def init_pgsql_compute():
         create_table_query = """
         CREATE TABLE IF NOT EXISTS nonces
         (
-                provider         varchar(255) NOT NULL,
-                nonce            varchar(255)
+                provider         varchar(255) PRIMARY KEY,
+                nonce            numeric
         );
         """
         cursor.execute(create_table_query)
@@ -115,31 +116,9 @@ def init_pgsql_compute():
     except (Exception, psycopg2.Error) as error:
         output = output + "Error PostgreSQL:" + str(error)
 
-    # add more columns with alter, to insure backwards compat
-    try:
-        cursor = connection.cursor()
-        table_query = "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS did varchar(255)"
-        cursor.execute(table_query)
-    except (Exception, psycopg2.Error) as error:
-        output = output + "Error PostgreSQL:" + str(error)
-    # add more columns with alter, to insure backwards compat
-    try:
-        cursor = connection.cursor()
-        table_query = "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS chainid varchar(255)"
-        cursor.execute(table_query)
-    except (Exception, psycopg2.Error) as error:
-        output = output + "Error PostgreSQL:" + str(error)
-
-    # add more columns with alter, to insure backwards compat
-    try:
-        cursor = connection.cursor()
-        table_query = "CREATE INDEX IF NOT EXISTS indx_owner_jobs ON jobs(owner)"
-        cursor.execute(table_query)
-    except (Exception, psycopg2.Error) as error:
-        output = output + "Error PostgreSQL:" + str(error)
-
     if connection and cursor:
         cursor.close()
+        output = output + run_migrations(connection)
         connection.close()
     return output, 200
 
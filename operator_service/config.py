@@ -1,6 +1,12 @@
+import json
+import logging
 import os
+import signal
+import threading
 from configparser import ConfigParser
 
+logger = logging.getLogger(__name__)
+
 
 class Config:
     def __init__(self):
@@ -22,3 +28,77 @@ class Config:
         self.plural = config_parser.get(
             "resources", "plural"
         )  # str | The custom resource's plural name. For TPRs this would be
+
+
+class AllowList:
+    """
+    Lower-cased addresses from a JSON array, read from the `name` env var or from
+    the file set in `<name>_FILE`. The list is parsed again only when the env var
+    or the file modification time changes, or after reload() (see SIGHUP below).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._source = None
+        self._addresses = frozenset()
+        self._lock = threading.Lock()
+
+    def _get_source(self):
+        path = os.getenv(f"{self.name}_FILE")
+        if not path:
+            return "env", os.getenv(self.name)
+        try:
+            return "file", path, os.stat(path).st_mtime_ns
+        except OSError:
+            return "file", path, None
+
+    def _parse(self, source):
+        try:
+            if source[0] == "file":
+                with open(source[1], "rt") as f:
+                    raw = f.read()
+            else:
+                raw = source[1]
+            if raw is None:
+                return frozenset()
+            addresses = json.loads(raw)
+            if not isinstance(addresses, list):
+                logger.error(f"Failed loading {self.name}: not a list")
+                return frozenset()
+            return frozenset(str(address).lower() for address in addresses)
+        except Exception as e:
+            logger.error(f"Failed loading {self.name}: {e}")
+            return frozenset()
+
+    def get(self):
+        source = self._get_source()
+        if source != self._source:
+            with self._lock:
+                if source != self._source:
+                    self._addresses = self._parse(source)
+                    self._source = source
+        return self._addresses
+
+    def reload(self):
+        self._source = None
+
+    def __contains__(self, address):
+        return bool(address) and address.lower() in self.get()
+
+
+allowed_providers = AllowList("ALLOWED_PROVIDERS")
+allowed_admins = AllowList("ALLOWED_ADMINS")
+
+
+def reload_allow_lists(*_):
+    allowed_providers.reload()
+    allowed_admins.reload()
+
+
+def install_reload_handler():
+    # SIGHUP forces the allow-lists to be parsed again, signals can only be
+    # registered from the main thread
+    try:
+        signal.signal(signal.SIGHUP, reload_allow_lists)
+    except ValueError:
+        logger.warning("Not in main thread, SIGHUP reload handler not installed")
@@ -1,42 +1,84 @@
 import os
 import logging
+import threading
+import time
+import uuid
 
 import psycopg2
-import simplejson as json
+import psycopg2.extras
+import psycopg2.pool
 
-logging.basicConfig(format="%(asctime)s %(message)s")
-logger = logging.getLogger("operator-service")
-logger.setLevel(logging.DEBUG)
+from operator_service import json_codec as json
+from operator_service.exceptions import DatabaseUnavailableError
+from operator_service.metrics import (
+    POOL_CONNECTIONS_USED,
+    QUERY_ERRORS,
+    QUERY_LATENCY,
+)
+
+logger = logging.getLogger(__name__)
+
+# json and jsonb columns are decoded by the same codec as everything else
+psycopg2.extras.register_default_json(loads=json.loads, globally=True)
+psycopg2.extras.register_default_jsonb(loads=json.loads, globally=True)
+
+
+def _epoch_text(value):
+    # epochs are numeric or double precision depending on the Postgresql
+    # version, providers get them as strings either way
+    return None if value is None else str(value)
+
+
+def _float_text(token):
+    # output floats are sent to providers as strings
+    return str(float(token))
 
 
 def get_sql_status(agreement_id, job_id, owner, chain_id):
+    return list(iter_sql_status(agreement_id, job_id, owner, chain_id))
+
+
+def _add_keyset_pagination(select_query, params, limit, after):
+    # keyset pagination on (dateCreated, workflowId), `after` is the
+    # (dateCreated epoch, workflowId) of the last row of the previous page
+    if after is not None:
+        select_query = (
+            select_query
+            + " AND (dateCreated, workflowId) > "
+            + "(to_timestamp(%(afterDate)s::double precision) AT TIME ZONE 'UTC', %(afterJobId)s)"
+        )
+        params["afterDate"] = str(after[0])
+        params["afterJobId"] = str(after[1])
+    if limit is not None or after is not None:
+        select_query = select_query + " ORDER BY dateCreated, workflowId"
+    if limit is not None:
+        select_query = select_query + " LIMIT %(limit)s"
+        params["limit"] = int(limit)
+    return select_query
+
+
+def iter_sql_status(agreement_id, job_id, owner, chain_id, limit=None, after=None):
     # enforce strings
     params = dict()
     select_query = """
     SELECT agreementId, workflowId, owner, status, statusText,
         extract(epoch from dateCreated) as dateCreated,
         extract(epoch from dateFinished) as dateFinished,
-        configlogURL, publishlogURL, algologURL, outputsURL, ddo, stopreq, removed , workflow
+        outputsURL, stopreq, removed, algoDID, inputDIDs
     FROM jobs WHERE 1=1
     """
 
-    if agreement_id is not None:
-        select_query = select_query + " AND agreementId=%(agreementId)s"
-        params["agreementId"] = str(agreement_id)
-
-    if job_id is not None:
-        select_query = select_query + " AND workflowId=%(jobId)s"
-        params["jobId"] = str(job_id)
+    select_query = _add_job_filter(select_query, params, agreement_id, job_id, owner)
+    select_query = _add_chain_filter(select_query, params, chain_id)
+    select_query = _add_keyset_pagination(select_query, params, limit, after)
 
-    if owner is not None:
-        select_query = select_query + " AND owner=%(owner)s"
-        params["owner"] = str(owner)
-
-    result = []
-    rows = _execute_query(select_query, params, "get_sql_status", get_rows=True)
-    if not rows:
-        return result
+    # owner-wide histories can be large, stream them with a server-side cursor
+    if agreement_id is None and job_id is None:
+        fetch_mode = FETCH_SERVER
+    else:
+        fetch_mode = FETCH_MANY
 
+    rows = _iter_query(select_query, params, "get_sql_status", fetch_mode)
     for row in rows:
         temprow = dict()
         temprow["agreementId"] = row[0]
@@ -44,40 +86,57 @@ def get_sql_status(agreement_id, job_id, owner, chain_id):
         temprow["owner"] = row[2]
         temprow["status"] = row[3]
         temprow["statusText"] = row[4]
-        temprow["dateCreated"] = row[5]
-        temprow["dateFinished"] = row[6]
-        # temprow['configlogUrl']=row[7]
-        # temprow['publishlogUrl']=row[8]
-        # temprow['algorithmLogUrl'] = row[9]
+        temprow["dateCreated"] = _epoch_text(row[5])
+        temprow["dateFinished"] = _epoch_text(row[6])
         temprow["results"] = ""
-        if row[10] and len(str(row[10])) > 2:
-            # need to filter url from object
-            outputs = json.loads(str(row[10]))
+        if row[7] and len(str(row[7])) > 2:
+            # need to filter url from object, the stored key order is kept
+            outputs = json.loads(str(row[7]), parse_float=_float_text)
             for i, entry in enumerate(outputs):
                 if outputs[i] and "url" in outputs[i]:
                     del outputs[i]["url"]
             temprow["results"] = outputs
-        # temprow['resultsDid'] = ''
-        # if row[11] and len(str(row[11])) > 2:
-        #    ddo_json = json.loads(str(row[11]))
-        #    temprow['resultsDid'] = ddo_json.get('id', '')
-        temprow["stopreq"] = row[12]
-        temprow["removed"] = row[13]
-        workflow_dict = json.loads(row[14])
-        if chain_id and "chainId" in workflow_dict:
-            if chain_id != workflow_dict["chain_id"]:
-                continue
-        stage = workflow_dict["spec"]["metadata"]["stages"][0]
-        if "id" in stage["algorithm"]:
-            temprow["algoDID"] = stage["algorithm"]["id"]
-        else:
-            temprow["algoDID"] = "raw"
-        temprow["inputDID"] = list()
-        for input in stage["input"]:
-            if "id" in input:
-                temprow["inputDID"].append(input["id"])
-        result.append(temprow)
-    return result
+        temprow["stopreq"] = row[8]
+        temprow["removed"] = row[9]
+        temprow["algoDID"] = row[10]
+        temprow["inputDID"] = row[11] or []
+        yield temprow
+
+
+# jobs rows are fingerprinted by laststatusupdate, which the trigger of migration 6
+# moves whenever a column returned by the status endpoints changes. The sum
+# catches updates committed with an older timestamp than the current max
+_JOBS_FINGERPRINT_QUERY = """
+    SELECT count(*), max(laststatusupdate), sum(extract(epoch from laststatusupdate))
+    FROM jobs
+"""
+
+
+def get_sql_status_fingerprint(agreement_id, job_id, owner, chain_id):
+    """
+    :return: tuple which changes whenever the result of get_sql_status does,
+    None on database errors
+    """
+    params = dict()
+    select_query = _JOBS_FINGERPRINT_QUERY + " WHERE 1=1"
+    select_query = _add_job_filter(select_query, params, agreement_id, job_id, owner)
+    select_query = _add_chain_filter(select_query, params, chain_id)
+    rows = _execute_query(
+        select_query, params, "get_sql_status_fingerprint", get_rows=True
+    )
+    return tuple(rows[0]) if rows else None
+
+
+def get_sql_running_jobs_fingerprint():
+    """
+    :return: tuple which changes whenever the result of iter_sql_running_jobs
+    does, None on database errors
+    """
+    select_query = _JOBS_FINGERPRINT_QUERY + " WHERE dateFinished IS NULL"
+    rows = _execute_query(
+        select_query, dict(), "get_sql_running_jobs_fingerprint", get_rows=True
+    )
+    return tuple(rows[0]) if rows else None
 
 
 def get_sql_job_urls(job_id):
@@ -101,40 +160,37 @@ def get_sql_job_urls(job_id):
         return None, None
 
 
-def get_sql_jobs(agreement_id, job_id, owner):
-    params = dict()
-    select_query = "SELECT workflowId FROM jobs WHERE 1=1"
+def _add_job_filter(query, params, agreement_id, job_id, owner):
     if agreement_id is not None:
-        select_query = select_query + " AND agreementId=%(agreementId)s"
+        query = query + " AND agreementId=%(agreementId)s"
         params["agreementId"] = str(agreement_id)
     if job_id is not None:
-        select_query = select_query + " AND workflowId=%(jobId)s"
+        query = query + " AND workflowId=%(jobId)s"
         params["jobId"] = str(job_id)
     if owner is not None:
-        select_query = select_query + " AND owner=%(owner)s"
+        query = query + " AND owner=%(owner)s"
         params["owner"] = str(owner)
-    try:
-        rows = _execute_query(select_query, params, "get_sql_jobs", get_rows=True)
-        if not rows:
-            return []
-        return [row[0] for row in rows]
-    except (Exception, psycopg2.Error) as error:
-        logger.error(f"PG query error: {error}")
-        return
+    return query
 
 
-def get_sql_running_jobs():
+def _add_chain_filter(query, params, chain_id):
+    if chain_id:
+        # jobs created without a chainId are not filtered out
+        query = query + " AND (chainId IS NULL OR chainId=%(chainId)s)"
+        params["chainId"] = str(chain_id)
+    return query
+
+
+def iter_sql_running_jobs(limit=None, after=None):
     # enforce strings
     params = dict()
     select_query = """
     SELECT agreementId, workflowId, owner, status, statusText,
         extract(epoch from dateCreated) as dateCreated,
-        namespace,workflow FROM jobs WHERE dateFinished IS NULL
+        namespace, chainId, algoDID, inputDIDs FROM jobs WHERE dateFinished IS NULL
     """
-    result = []
-    rows = _execute_query(select_query, params, "get_sql_status", get_rows=True)
-    if not rows:
-        return result
+    select_query = _add_keyset_pagination(select_query, params, limit, after)
+    rows = _iter_query(select_query, params, "get_sql_running_jobs", FETCH_MANY)
     for row in rows:
         temprow = dict()
         temprow["agreementId"] = row[0]
@@ -142,22 +198,23 @@ def get_sql_running_jobs():
         temprow["owner"] = row[2]
         temprow["status"] = row[3]
         temprow["statusText"] = row[4]
-        temprow["dateCreated"] = row[5]
+        temprow["dateCreated"] = _epoch_text(row[5])
         temprow["namespace"] = row[6]
-        workflow_dict = json.loads(row[7])
-        stage = workflow_dict["spec"]["metadata"]["stages"][0]
-        if "chainId" in workflow_dict:
-            temprow["chainId"] = workflow_dict["chainId"]
-        if "id" in stage["algorithm"]:
-            temprow["algoDID"] = stage["algorithm"]["id"]
-        else:
-            temprow["algoDID"] = "raw"
-        temprow["inputDID"] = list()
-        for input in stage["input"]:
-            if "id" in input:
-                temprow["inputDID"].append(input["id"])
-        result.append(temprow)
-    return result
+        temprow["chainId"] = row[7]
+        temprow["algoDID"] = row[8]
+        temprow["inputDID"] = row[9] or []
+        yield temprow
+
+
+def is_agreement_id_in_use(agreement_id):
+    # only unfinished jobs block an agreementId, backed by indx_agreementId_running
+    params = dict()
+    select_query = """
+    SELECT 1 FROM jobs WHERE agreementId=%(agreementId)s AND dateFinished IS NULL LIMIT 1
+    """
+    params["agreementId"] = str(agreement_id)
+    rows = _execute_query(select_query, params, "is_agreement_id_in_use", get_rows=True)
+    return bool(rows)
 
 
 def get_nonce_for_certain_provider(provider_address: str):
@@ -165,104 +222,143 @@ def get_nonce_for_certain_provider(provider_address: str):
     select_query = """SELECT nonce FROM nonces WHERE provider = %(provider)s"""
     params["provider"] = provider_address
 
-    try:
-        rows = _execute_query(select_query, params, "get_nonce", get_rows=True)
-        if not rows:
-            logger.info("nonce is null")
-            return []
-        values = []
-        for row in rows:
-            if isinstance(row[0], str) and len(row[0]) == 19:
-                values.append(int(row[0]))
-            else:
-                values.append(float(row[0]))
-
-        logger.info(f"nonce found: {max(values)}")
-        return max(values)
-    except (Exception, psycopg2.Error) as error:
-        logger.error(f"PG query error: {error}")
-        return
+    rows = _execute_query(select_query, params, "get_nonce", get_rows=True)
+    if not rows:
+        logger.debug("nonce is null")
+        return None
+    logger.debug("nonce found: %s", rows[0][0])
+    return rows[0][0]
 
 
 def update_nonce_for_a_certain_provider(nonce: str, provider_address: str):
-    # check if provider address exists
+    """
+    Stores the nonce of a provider, only if it is greater than the stored one.
+    Check and update happen in a single statement, so concurrent requests
+    reusing a nonce can not both succeed.
+    :return: True if the nonce was accepted, False if it was not greater than
+        the stored one, None on database error
+    """
+    postgres_upsert_query = """
+        INSERT INTO nonces (provider, nonce) VALUES (%(provider)s, %(nonce)s)
+        ON CONFLICT (provider) DO UPDATE SET nonce = EXCLUDED.nonce
+            WHERE nonces.nonce < EXCLUDED.nonce
+        RETURNING nonce
+    """
     params = dict()
-    select_query = """SELECT provider FROM nonces WHERE provider = %(provider)s"""
     params["provider"] = provider_address
+    params["nonce"] = str(nonce)
 
-    try:
-        rows = _execute_query(select_query, params, "get_provider", get_rows=True)
-        if not rows:
-            # creates a new row if necessary
-            postgres_insert_query = (
-                """INSERT INTO nonces (provider, nonce) VALUES (%s, %s)"""
-            )
-            record_to_insert = (
-                provider_address,
-                nonce,
-            )
-
-            try:
-                _execute_query(postgres_insert_query, record_to_insert, "create_nonce")
-                logger.debug(f"create_nonce: {provider_address}, new nonce {nonce}")
-                return
-            except (Exception, psycopg2.Error) as error:
-                logger.error(f"PG query error from creating nonce row: {error}")
-                return
-    except (Exception, psycopg2.Error) as error:
-        logger.error(f"PG query error from getting the provider address: {error}")
-        return
-
-    postgres_insert_query = """UPDATE nonces SET nonce=%s WHERE provider=%s"""
-    record_to_insert = (
-        nonce,
-        provider_address,
+    rows = _execute_query(
+        postgres_upsert_query, params, "update_nonce", get_rows=True, commit=True
+    )
+    if rows is None:
+        return None
+    logger.debug(
+        "update_nonce: %s, new nonce %s: %s", provider_address, nonce, bool(rows)
     )
+    return bool(rows)
 
-    return _execute_query(postgres_insert_query, record_to_insert, "update_nonce")
+
+def _add_allowed_chain_filter(query, params, chain_id):
+    # environments with a non empty allowedChainId list only serve those chains.
+    # Containment keeps the JSON type of chain_id, "1" does not match 1. The
+    # status column is the JSON text sent by op-engine
+    query = query + """ AND (status::jsonb @> %(allowedChainId)s::jsonb
+        OR jsonb_typeof(status::jsonb->'allowedChainId') IS DISTINCT FROM 'array'
+        OR status::jsonb->'allowedChainId' = '[]'::jsonb)"""
+    params["allowedChainId"] = json.dumps({"allowedChainId": [chain_id]})
+    return query
 
 
 def get_sql_environments(logger, chain_id):
     params = dict()
     select_query = """
-    SELECT namespace, status,extract(epoch from lastping) as lastping from envs
+    SELECT namespace, status,extract(epoch from lastping) as lastping from envs WHERE 1=1
     """
+    select_query = _add_allowed_chain_filter(select_query, params, chain_id)
     result = []
     rows = _execute_query(select_query, params, "get_sql_environments", get_rows=True)
     if not rows:
         return result
     for row in rows:
         temprow = json.loads(row[1])
-        if "allowedChainId" in temprow:
-            if isinstance(temprow["allowedChainId"], list):
-                if len(temprow["allowedChainId"]):
-                    if not (chain_id in temprow["allowedChainId"]):
-                        continue
         temprow["lastSeen"] = str(row[2])
         temprow["id"] = row[0]
         result.append(temprow)
     return result
 
 
+_environments_cache = {"checked": None, "fingerprint": None, "by_chain": dict()}
+_environments_lock = threading.Lock()
+
+
+def _get_environments_fingerprint():
+    # envs rows only change through announce(), which always moves lastping
+    select_query = """
+    SELECT count(*), max(lastping), sum(extract(epoch from lastping)) from envs
+    """
+    rows = _execute_query(
+        select_query, dict(), "get_environments_fingerprint", get_rows=True
+    )
+    return tuple(rows[0]) if rows else None
+
+
+def get_cached_environments(chain_id):
+    """
+    Per worker cache of get_sql_environments, keyed by chain_id.
+    Once ENVIRONMENTS_CACHE_TTL seconds have passed, the cache is checked against
+    the envs table and dropped if an environment was announced in the meantime.
+    """
+    ttl = _get_float_env("ENVIRONMENTS_CACHE_TTL", 5)
+    if ttl <= 0:
+        return get_sql_environments(logger, chain_id)
+    with _environments_lock:
+        _check_environments_cache(ttl)
+        by_chain = _environments_cache["by_chain"]
+        if chain_id not in by_chain:
+            # chainId comes from the request, do not let it grow without bounds
+            if len(by_chain) >= _get_int_env("ENVIRONMENTS_CACHE_SIZE", 256):
+                by_chain.clear()
+            by_chain[chain_id] = get_sql_environments(logger, chain_id)
+        return by_chain[chain_id]
+
+
+def _check_environments_cache(ttl):
+    # called with _environments_lock held
+    now = time.monotonic()
+    checked = _environments_cache["checked"]
+    if checked is None or now - checked >= ttl:
+        fingerprint = _get_environments_fingerprint()
+        if fingerprint != _environments_cache["fingerprint"]:
+            _environments_cache["fingerprint"] = fingerprint
+            _environments_cache["by_chain"] = dict()
+        _environments_cache["checked"] = now
+
+
+def get_cached_environments_fingerprint():
+    """
+    :return: fingerprint of the environments served by get_cached_environments,
+    None on database errors
+    """
+    ttl = _get_float_env("ENVIRONMENTS_CACHE_TTL", 5)
+    if ttl <= 0:
+        return _get_environments_fingerprint()
+    with _environments_lock:
+        _check_environments_cache(ttl)
+        return _environments_cache["fingerprint"]
+
+
 def check_environment_exists(environment, chain_id):
     params = dict()
     select_query = """
-    SELECT namespace, status,extract(epoch from lastping) as lastping from envs WHERE namespace=%(env)s
+    SELECT 1 from envs WHERE namespace=%(env)s
     """
     params["env"] = environment
+    select_query = _add_allowed_chain_filter(select_query, params, chain_id)
     rows = _execute_query(
         select_query, params, "check_environment_exists", get_rows=True
     )
-    if not rows:
-        return False
-
-    status = json.loads(rows[0][1])
-    if "allowedChainId" in status:
-        if isinstance(status["allowedChainId"], list):
-            if len(status["allowedChainId"]):
-                if not (chain_id in status["allowedChainId"]):
-                    return False
-    return True
+    return bool(rows)
 
 
 def get_job_by_provider_and_owner(owner, provider):
@@ -294,47 +390,131 @@ def get_job_by_provider_and_owner(owner, provider):
     return result
 
 
+def get_workflow_dids(workflow):
+    """
+    Extracts the algorithm DID and the input DIDs from the first stage of a workflow.
+    Stored in their own columns, so status reads never parse the workflow.
+    """
+    stage = workflow["stages"][0]
+    if "id" in stage["algorithm"]:
+        algo_did = stage["algorithm"]["id"]
+    else:
+        algo_did = "raw"
+    input_dids = list()
+    for input in stage["input"]:
+        if "id" in input:
+            input_dids.append(input["id"])
+    return algo_did, input_dids
+
+
 def create_sql_job(agreement_id, job_id, owner, body, namespace, provider_address):
+    """
+    Inserts the job and returns its status, like get_sql_status would,
+    None if the insert failed.
+    """
     postgres_insert_query = """
         INSERT
             INTO jobs
-                (agreementId,workflowId,owner,status,statusText,workflow,namespace,provider)
+                (agreementId,workflowId,owner,status,statusText,workflow,namespace,provider,
+                chainId,algoDID,inputDIDs)
             VALUES
-                (%s, %s, %s, %s, %s,%s,%s,%s)"""
+                (%s, %s, %s, %s, %s,%s,%s,%s,%s,%s,%s)
+            RETURNING extract(epoch from dateCreated) as dateCreated, status, statusText"""
+    workflow = body["spec"]["metadata"]
+    chain_id = workflow.get("chainId")
+    algo_did, input_dids = get_workflow_dids(workflow)
     record_to_insert = (
         str(agreement_id),
         str(job_id),
         str(owner),
         1,
         "Warming up",
-        json.dumps(body),
+        json.dumps(body, ensure_ascii=True),
         namespace,
         provider_address,
+        str(chain_id) if chain_id is not None else None,
+        algo_did,
+        input_dids,
+    )
+    rows = _execute_query(
+        postgres_insert_query,
+        record_to_insert,
+        "create_sql_job",
+        get_rows=True,
+        commit=True,
     )
-    return _execute_query(postgres_insert_query, record_to_insert, "create_sql_job")
+    if not rows:
+        return None
+    date_created, status, status_text = rows[0]
+    return {
+        "agreementId": str(agreement_id),
+        "jobId": str(job_id),
+        "owner": str(owner),
+        "status": status,
+        "statusText": status_text,
+        "dateCreated": _epoch_text(date_created),
+        "dateFinished": None,
+        "results": "",
+        "stopreq": 0,
+        "removed": 0,
+        "algoDID": algo_did,
+        "inputDID": input_dids or [],
+    }
+
+
+def _update_sql_jobs(update_query, agreement_id, job_id, owner, msg):
+    # one statement and one transaction for all the matching jobs
+    params = dict()
+    update_query = _add_job_filter(update_query, params, agreement_id, job_id, owner)
+    rows = _execute_query(
+        update_query + " RETURNING workflowId", params, msg, get_rows=True, commit=True
+    )
+    if rows is None:
+        return None
+    return [row[0] for row in rows]
 
 
-def stop_sql_job(execution_id):
-    postgres_insert_query = """UPDATE jobs SET stopreq=1 WHERE workflowId=%s"""
-    record_to_insert = (str(execution_id),)
-    return _execute_query(postgres_insert_query, record_to_insert, "stop_sql_job")
+def stop_sql_jobs(agreement_id, job_id, owner):
+    """
+    Requests a stop for all the jobs matching the filter
+    :return: workflowIds of the jobs, None on database errors
+    """
+    return _update_sql_jobs(
+        "UPDATE jobs SET stopreq=1 WHERE 1=1",
+        agreement_id,
+        job_id,
+        owner,
+        "stop_sql_jobs",
+    )
 
 
-def remove_sql_job(execution_id):
-    postgres_insert_query = """ UPDATE jobs SET removed=1 WHERE workflowId=%s"""
-    record_to_insert = (str(execution_id),)
-    return _execute_query(postgres_insert_query, record_to_insert, "remove_sql_job")
+def remove_sql_jobs(agreement_id, job_id, owner):
+    """
+    Marks all the jobs matching the filter as removed
+    :return: workflowIds of the jobs, None on database errors
+    """
+    return _update_sql_jobs(
+        "UPDATE jobs SET removed=1 WHERE 1=1",
+        agreement_id,
+        job_id,
+        owner,
+        "remove_sql_jobs",
+    )
+
+
+def get_pg_connection_params():
+    return dict(
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        host=os.getenv("POSTGRES_HOST"),
+        port=os.getenv("POSTGRES_PORT", 5432),
+        database=os.getenv("POSTGRES_DB"),
+    )
 
 
 def get_pg_connection_and_cursor():
     try:
-        connection = psycopg2.connect(
-            user=os.getenv("POSTGRES_USER"),
-            password=os.getenv("POSTGRES_PASSWORD"),
-            host=os.getenv("POSTGRES_HOST"),
-            port=os.getenv("POSTGRES_PORT", 5432),
-            database=os.getenv("POSTGRES_DB"),
-        )
+        connection = psycopg2.connect(**get_pg_connection_params())
         connection.set_client_encoding("LATIN9")
         cursor = connection.cursor()
         return connection, cursor
@@ -343,26 +523,241 @@ def get_pg_connection_and_cursor():
         return None, None
 
 
-def _execute_query(query, record, msg, get_rows=False):
-    connection, cursor = get_pg_connection_and_cursor()
-    if not connection or not cursor:
-        return
+# result fetching modes of _iter_query
+FETCH_ALL = "all"  # one fetchall() call
+FETCH_MANY = "many"  # fetchmany() batches of POSTGRES_FETCH_ARRAYSIZE rows
+FETCH_SERVER = "server"  # named server-side cursor, rows are pulled in batches
+
+# process-wide connection pool, created lazily and re-created after a fork
+# (gunicorn pre-fork workers must never share the parent's sockets)
+_pg_pool = None
+_pg_pool_pid = None
+_pg_pool_last_used = dict()
+# one slot per pooled connection, checkouts wait for a free one
+_pg_pool_slots = None
+# pool and slots each checked out connection goes back to, by connection id
+_pg_pool_checkouts = dict()
+_pg_pool_lock = threading.Lock()
+
+
+def _get_int_env(name, default):
     try:
-        cursor.execute(query, record)
-        if get_rows:
-            result = []
-            row = cursor.fetchone()
-            while row is not None:
-                result.append(row)
-                row = cursor.fetchone()
-            return result
-        else:
-            connection.commit()
+        return int(os.getenv(name, default))
+    except ValueError:
+        logger.error(f"Invalid value for {name}, using default {default}")
+        return default
 
+
+def _get_float_env(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logger.error(f"Invalid value for {name}, using default {default}")
+        return default
+
+
+def get_pg_pool():
+    """
+    Returns the connection pool of the current process, creating it if needed.
+    Pool size is controlled by POSTGRES_POOL_MIN and POSTGRES_POOL_MAX.
+    """
+    global _pg_pool, _pg_pool_pid, _pg_pool_slots
+    if _pg_pool is not None and _pg_pool_pid == os.getpid():
+        return _pg_pool
+
+    # the pool connects eagerly, concurrent first requests must not build two
+    with _pg_pool_lock:
+        if _pg_pool is not None and _pg_pool_pid == os.getpid():
+            return _pg_pool
+
+        if _pg_pool_pid != os.getpid():
+            # inherited from the parent process: drop it without closing its sockets
+            _pg_pool_last_used.clear()
+            _pg_pool_checkouts.clear()
+        min_conn = _get_int_env("POSTGRES_POOL_MIN", 1)
+        max_conn = max(min_conn, _get_int_env("POSTGRES_POOL_MAX", 10))
+        pool = psycopg2.pool.ThreadedConnectionPool(
+            min_conn, max_conn, client_encoding="LATIN9", **get_pg_connection_params()
+        )
+        _pg_pool_slots = threading.BoundedSemaphore(max_conn)
+        _pg_pool, _pg_pool_pid = pool, os.getpid()
+        logger.info(f"Created PG connection pool, min: {min_conn}, max: {max_conn}")
+        return pool
+
+
+def _is_connection_healthy(connection):
+    if connection.closed:
+        return False
+    status = connection.info.transaction_status
+    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+
+    # only ping connections which sat idle long enough to be dropped by a
+    # firewall or a server restart, so hot connections cost no extra round trip
+    ping_interval = _get_float_env("POSTGRES_POOL_PING_INTERVAL", 30)
+    last_used = _pg_pool_last_used.get(id(connection))
+    if last_used is None or time.monotonic() - last_used < ping_interval:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except (Exception, psycopg2.Error):
+        return False
+
+
+def _acquire_pool_slot(slots):
+    # ThreadedConnectionPool raises PoolError as soon as all the connections are
+    # checked out, wait for one to be released instead (cooperative under gevent)
+    timeout = _get_float_env("POSTGRES_POOL_TIMEOUT", 10)
+    if not slots.acquire(timeout=timeout):
+        QUERY_ERRORS.labels("pool_timeout").inc()
+        raise DatabaseUnavailableError(
+            f"No free PG connection in the pool after {timeout}s"
+        )
+    return slots
+
+
+def get_pooled_connection():
+    """
+    Checks out a healthy connection from the pool.
+    Waits up to POSTGRES_POOL_TIMEOUT seconds when all the connections are in use,
+    retries with exponential backoff (POSTGRES_CONNECT_RETRIES, POSTGRES_CONNECT_BACKOFF)
+    when the database is unreachable.
+    :raises DatabaseUnavailableError: when no connection could be checked out
+    """
+    retries = _get_int_env("POSTGRES_CONNECT_RETRIES", 3)
+    backoff = _get_float_env("POSTGRES_CONNECT_BACKOFF", 0.1)
+    pool = slots = None
+    for attempt in range(retries + 1):
+        try:
+            if pool is None:
+                pool = get_pg_pool()
+                # slots of this pool, a replacement pool comes with its own
+                slots = _acquire_pool_slot(_pg_pool_slots)
+            connection = pool.getconn()
+            # stale connections are dropped right away, they do not count as attempts
+            while not _is_connection_healthy(connection):
+                logger.warning("Discarding broken PG connection from pool")
+                _pg_pool_last_used.pop(id(connection), None)
+                pool.putconn(connection, close=True)
+                connection = pool.getconn()
+            _pg_pool_checkouts[id(connection)] = (pool, slots)
+            POOL_CONNECTIONS_USED.inc()
+            return connection
+        except DatabaseUnavailableError:
+            raise
+        except (Exception, psycopg2.Error) as error:
+            logger.error(f"PG pool connect error (attempt {attempt + 1}): {error}")
+        if attempt < retries:
+            time.sleep(backoff * (2**attempt))
+    if slots is not None:
+        slots.release()
+    raise DatabaseUnavailableError(f"PG connect failed after {retries + 1} attempts")
+
+
+def release_pooled_connection(connection, broken=False):
+    """
+    Returns a connection to the pool. Open transactions are rolled back by the pool,
+    broken connections are closed instead of being reused.
+    """
+    # connections go back to the pool they came from, even if it was replaced
+    checkout = _pg_pool_checkouts.pop(id(connection), None)
+    if checkout is None:
+        return
+    pool, slots = checkout
+    broken = broken or bool(connection.closed)
+    if broken:
+        _pg_pool_last_used.pop(id(connection), None)
+    else:
+        _pg_pool_last_used[id(connection)] = time.monotonic()
+    try:
+        pool.putconn(connection, close=broken)
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"PG pool release error: {error}")
+    finally:
+        POOL_CONNECTIONS_USED.dec()
+        slots.release()
+
+
+def _execute_query(query, record, msg, get_rows=False, commit=None):
+    # by default only queries which do not return rows are committed,
+    # use commit=True for writes with a RETURNING clause
+    if commit is None:
+        commit = not get_rows
+    # raises DatabaseUnavailableError, callers must not read it as "no rows"
+    connection = get_pooled_connection()
+    broken = False
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        with QUERY_LATENCY.labels(msg).time():
+            cursor.execute(query, record)
+            rows = cursor.fetchall() if get_rows else None
+            if commit:
+                connection.commit()
+        return rows
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+        broken = True
+        QUERY_ERRORS.labels(msg).inc()
+        logger.error(f"Got PG error in {msg}: {error}")
     except (Exception, psycopg2.Error) as error:
+        QUERY_ERRORS.labels(msg).inc()
         logger.error(f"Got PG error in {msg}: {error}")
     finally:
-        # closing database connection.
-        if connection:
+        # give the connection back to the pool
+        if cursor is not None:
             cursor.close()
-            connection.close()
+        release_pooled_connection(connection, broken)
+
+
+def _iter_query(query, record, msg, fetch_mode=FETCH_MANY, arraysize=None):
+    """
+    Lazily yields the rows of a read query, so callers can build their results
+    without materializing an intermediate list of tuples.
+    The connection stays checked out until the generator is exhausted or closed.
+    Errors are re-raised, a stream cut short must not look like a complete result.
+    """
+    if arraysize is None:
+        arraysize = _get_int_env("POSTGRES_FETCH_ARRAYSIZE", 1000)
+    connection = get_pooled_connection()
+    broken = False
+    cursor = None
+    try:
+        if fetch_mode == FETCH_SERVER:
+            cursor = connection.cursor(name=f"{msg}_{uuid.uuid4().hex}")
+            cursor.itersize = arraysize
+            with QUERY_LATENCY.labels(msg).time():
+                cursor.execute(query, record)
+            yield from cursor
+        else:
+            cursor = connection.cursor()
+            cursor.arraysize = arraysize
+            with QUERY_LATENCY.labels(msg).time():
+                cursor.execute(query, record)
+            if fetch_mode == FETCH_ALL:
+                yield from cursor.fetchall()
+            else:
+                rows = cursor.fetchmany()
+                while rows:
+                    yield from rows
+                    rows = cursor.fetchmany()
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+        broken = True
+        QUERY_ERRORS.labels(msg).inc()
+        logger.error(f"Got PG error in {msg}: {error}")
+        raise
+    except (Exception, psycopg2.Error) as error:
+        QUERY_ERRORS.labels(msg).inc()
+        logger.error(f"Got PG error in {msg}: {error}")
+        raise
+    finally:
+        if cursor is not None:
+            try:
+                cursor.close()
+            except (Exception, psycopg2.Error) as error:
+                logger.error(f"Got PG error closing cursor in {msg}: {error}")
+        release_pooled_connection(connection, broken)
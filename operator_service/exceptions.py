@@ -1,2 +1,6 @@
 class InvalidSignatureError(Exception):
     """ """
+
+
+class DatabaseUnavailableError(Exception):
+    """No database connection could be checked out, requests fail with 503."""
@@ -0,0 +1,76 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+import logging
+import os
+
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+# concurrent requests of a gevent worker per pooled Postgresql connection
+WORKER_CONNECTIONS_PER_DB_CONNECTION = 5
+
+
+def is_gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def gevent_wait_callback(connection, timeout=None):
+    """
+    Lets psycopg2 wait for the server through the gevent hub, so a query only
+    blocks its own greenlet instead of the whole worker.
+    """
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+
+def patch_psycopg():
+    """
+    Makes psycopg2 cooperative when running under gevent workers
+    (OPERATOR_WORKER_CLASS=gevent), does nothing for sync workers.
+    """
+    if not is_gevent_patched():
+        return False
+    extensions.set_wait_callback(gevent_wait_callback)
+    logger.info("psycopg2 is running in green mode")
+    return True
+
+
+def get_worker_connections():
+    """
+    gunicorn worker_connections of gevent workers, OPERATOR_WORKER_CONNECTIONS
+    capped to WORKER_CONNECTIONS_PER_DB_CONNECTION x POSTGRES_POOL_MAX, the
+    requests of a worker beyond its pool only wait for a free connection.
+    """
+    try:
+        pool_max = int(os.getenv("POSTGRES_POOL_MAX", 10))
+    except ValueError:
+        pool_max = 10
+    cap = pool_max * WORKER_CONNECTIONS_PER_DB_CONNECTION
+    try:
+        worker_connections = int(os.getenv("OPERATOR_WORKER_CONNECTIONS", cap))
+    except ValueError:
+        logger.error(f"Invalid value for OPERATOR_WORKER_CONNECTIONS, using {cap}")
+        return cap
+    if worker_connections > cap:
+        logger.warning(
+            f"OPERATOR_WORKER_CONNECTIONS capped to {cap}, raise POSTGRES_POOL_MAX"
+        )
+        return cap
+    return worker_connections
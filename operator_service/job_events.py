@@ -0,0 +1,192 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Job status changes pushed to /compute/watch clients.
+A trigger on the jobs table calls pg_notify on JOB_STATUS_CHANNEL whenever the
+status, statusText or dateFinished of a job change. Each worker process holds
+one LISTEN connection, read by a thread which fans the notifications out to
+the queues of the clients watching the job.
+"""
+
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+from operator_service import json_codec as json
+from operator_service.data_store import get_pg_connection_params
+from operator_service.metrics import WATCH_CLIENTS
+
+logger = logging.getLogger(__name__)
+
+# channel of the trigger created by migration 5
+JOB_STATUS_CHANNEL = "job_status"
+# queued when notifications may have been missed (listener reconnected, client
+# too slow), the client gets the current status of its jobs again
+RESYNC = None
+
+_subscribers = dict()  # queue -> fields an update must match
+_lock = threading.Lock()
+_listener = None
+_listener_pid = None
+
+
+def get_watch_settings():
+    """
+    :return: (keepalive interval, maximum stream duration) in seconds, from
+    WATCH_KEEPALIVE and WATCH_MAX_DURATION
+    """
+    return (
+        float(os.getenv("WATCH_KEEPALIVE", 15)),
+        float(os.getenv("WATCH_MAX_DURATION", 300)),
+    )
+
+
+def subscribe(agreement_id=None, job_id=None, owner=None):
+    """
+    :return: queue receiving the updates of the matching jobs, pass it to
+    unsubscribe once done
+    """
+    events = queue.Queue(maxsize=int(os.getenv("WATCH_QUEUE_SIZE", 100)))
+    filters = {"agreementId": agreement_id, "jobId": job_id, "owner": owner}
+    with _lock:
+        _subscribers[events] = {k: v for k, v in filters.items() if v is not None}
+        _start_listener()
+    WATCH_CLIENTS.inc()
+    return events
+
+
+def unsubscribe(events):
+    with _lock:
+        if _subscribers.pop(events, None) is None:
+            return
+    WATCH_CLIENTS.dec()
+
+
+def _put(events, update):
+    try:
+        events.put_nowait(update)
+    except queue.Full:
+        # the client does not keep up, replace its backlog by a resync
+        with events.mutex:
+            events.queue.clear()
+        events.put_nowait(RESYNC)
+
+
+def dispatch(payload):
+    """
+    Queues a notification payload for the clients watching its job.
+    """
+    try:
+        update = json.loads(payload)
+    except ValueError:
+        logger.error(f"Invalid job status notification: {payload}")
+        return
+    with _lock:
+        subscribers = list(_subscribers.items())
+    for events, filters in subscribers:
+        if all(update.get(k) == v for k, v in filters.items()):
+            _put(events, update)
+
+
+def _resync_all():
+    with _lock:
+        subscribers = list(_subscribers)
+    for events in subscribers:
+        _put(events, RESYNC)
+
+
+def _start_listener():
+    # called with _lock held. Threads do not survive a fork, each gunicorn
+    # worker starts its own listener
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    _listener = threading.Thread(
+        target=_listen, name="job-status-listener", daemon=True
+    )
+    _listener_pid = os.getpid()
+    _listener.start()
+
+
+def _stop_listener_if_idle():
+    global _listener
+    with _lock:
+        if _subscribers:
+            return False
+        _listener = None
+        return True
+
+
+def _listen():
+    retry_delay = 1
+    while True:
+        connection = None
+        try:
+            connection = psycopg2.connect(**get_pg_connection_params())
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute(f"LISTEN {JOB_STATUS_CHANNEL}")
+            logger.info("Listening to %s notifications", JOB_STATUS_CHANNEL)
+            # changes made before LISTEN took effect were not notified
+            _resync_all()
+            retry_delay = 1
+            while True:
+                if select.select([connection], [], [], 30) == ([], [], []):
+                    if _stop_listener_if_idle():
+                        return
+                    # detects connections dropped while idle
+                    cursor.execute("SELECT 1")
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    dispatch(connection.notifies.pop(0).payload)
+        except (Exception, psycopg2.Error) as error:
+            logger.error(f"Job status listener error: {error}")
+        finally:
+            if connection is not None:
+                connection.close()
+        if _stop_listener_if_idle():
+            return
+        time.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, 30)
+
+
+def _format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_job_events(events, get_statuses):
+    """
+    Server-Sent Events stream: a `status` event with the current status of each
+    watched job, then an `update` event for each change until WATCH_MAX_DURATION,
+    after which clients reconnect.
+    :param get_statuses: function returning the current status of the jobs
+    """
+    keepalive, max_duration = get_watch_settings()
+    deadline = time.monotonic() + max_duration
+    try:
+        # subscribed before reading the statuses, no change falls in between
+        for job in get_statuses():
+            yield _format_event("status", job)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                update = events.get(timeout=min(keepalive, remaining))
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if update is RESYNC:
+                for job in get_statuses():
+                    yield _format_event("status", job)
+            else:
+                yield _format_event("update", update)
+    finally:
+        unsubscribe(events)
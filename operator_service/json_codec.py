@@ -0,0 +1,78 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+JSON encoding and decoding of database columns and responses.
+Encoding uses orjson when installed (operator-service[orjson]), the standard
+library otherwise, or when JSON_BACKEND is set to "json". Both produce compact
+UTF-8 output, Decimal values are encoded as strings. Text written to Postgresql
+must use ensure_ascii=True, connections use the LATIN9 client encoding.
+"""
+
+import json
+import os
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(o):
+    if isinstance(o, Decimal):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def _with_default(default):
+    if default is None:
+        return _default
+
+    def _chained(o):
+        if isinstance(o, Decimal):
+            return str(o)
+        return default(o)
+
+    return _chained
+
+
+def _dumps_stdlib(obj, default, ensure_ascii):
+    return json.dumps(
+        obj,
+        default=_with_default(default),
+        separators=(",", ":"),
+        ensure_ascii=ensure_ascii,
+    )
+
+
+if orjson is not None and os.getenv("JSON_BACKEND", "orjson") != "json":
+    BACKEND = "orjson"
+
+    def dumps(obj, default=None, ensure_ascii=False):
+        try:
+            s = orjson.dumps(obj, default=_with_default(default)).decode("utf-8")
+        except TypeError:
+            # integers over 64 bits, non-string keys
+            return _dumps_stdlib(obj, default, ensure_ascii)
+        if ensure_ascii and not s.isascii():
+            # orjson cannot escape non-ASCII characters
+            return _dumps_stdlib(obj, default, ensure_ascii)
+        return s
+
+else:
+    BACKEND = "json"
+    _encoder = json.JSONEncoder(
+        default=_default, separators=(",", ":"), ensure_ascii=False
+    )
+
+    def dumps(obj, default=None, ensure_ascii=False):
+        if default is None and not ensure_ascii:
+            return _encoder.encode(obj)
+        return _dumps_stdlib(obj, default, ensure_ascii)
+
+
+def loads(s, parse_float=None):
+    # orjson reads integers over 64 bits as floats and has no parse_float
+    # hook, documents are always read by the standard library C decoder
+    return json.loads(s, parse_float=parse_float)
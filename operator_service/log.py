@@ -3,9 +3,12 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+import atexit
 import logging
 import logging.config
+import logging.handlers
 import os
+import queue
 from pathlib import Path
 
 import coloredlogs
@@ -38,3 +41,139 @@ def setup_logging(log_config_path=None, log_level=None):
     else:
         print(f"Using default logging config, log level = INFO")
         logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+    set_module_levels(os.getenv("LOG_LEVELS"))
+    truncate_messages(int(os.getenv("LOG_MAX_MESSAGE_SIZE", 4096)))
+    if os.getenv("LOG_QUEUE", "1") == "1":
+        move_handlers_to_queue()
+
+
+# plain values are safe to format later, in the listener thread
+_IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+_listeners = []
+
+
+def set_module_levels(levels):
+    """
+    Sets logger levels from a "module=LEVEL,other.module=LEVEL" string,
+    e.g. LOG_LEVELS="operator_service.data_store=DEBUG,urllib3=WARNING"
+    """
+    if not levels:
+        return
+    for item in levels.split(","):
+        name, _, level = item.strip().partition("=")
+        if name and level:
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+class TruncateFilter(logging.Filter):
+    """
+    Caps log messages to LOG_MAX_MESSAGE_SIZE characters, so logging a large
+    payload does not flood the handlers.
+    """
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_size:
+            message = (
+                f"{message[: self.max_size]}... "
+                f"[truncated {len(message) - self.max_size} chars]"
+            )
+        # formatted once, even with several handlers
+        record.msg = message
+        record.args = None
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records without formatting them when their arguments cannot change
+    in the meantime, formatting happens in the listener thread.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # tracebacks reference the frames of the calling thread
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        args = record.args
+        if args and not (
+            isinstance(args, tuple)
+            and all(isinstance(arg, _IMMUTABLE_TYPES) for arg in args)
+        ):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def _configured_loggers():
+    return [logging.getLogger()] + [
+        logging.getLogger(name)
+        for name, logger in logging.Logger.manager.loggerDict.items()
+        if isinstance(logger, logging.Logger) and logger.handlers
+    ]
+
+
+def _output_handlers(logger):
+    return [
+        handler
+        for handler in logger.handlers
+        if not isinstance(handler, logging.handlers.QueueHandler)
+    ]
+
+
+def truncate_messages(max_size):
+    """
+    Adds a TruncateFilter to the handlers of configured loggers, with or
+    without the logging queue.
+    """
+    for logger in _configured_loggers():
+        for handler in _output_handlers(logger):
+            if not any(isinstance(f, TruncateFilter) for f in handler.filters):
+                handler.addFilter(TruncateFilter(max_size))
+
+
+def move_handlers_to_queue():
+    """
+    Replaces the handlers of configured loggers by a queue, a listener thread
+    writes the records to the original handlers.
+    """
+    for logger in _configured_loggers():
+        handlers = _output_handlers(logger)
+        if not handlers:
+            continue
+        for handler in handlers:
+            logger.removeHandler(handler)
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(LazyQueueHandler(log_queue))
+        _listeners.append(_start_listener(log_queue, handlers))
+
+
+def _start_listener(log_queue, handlers):
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
+
+
+@atexit.register
+def stop_listeners():
+    # flushes the queued records
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def _restart_listeners():
+    # listener threads do not survive a fork, e.g. with gunicorn --preload, the
+    # child starts its own listeners on the same queues and handlers
+    for i, listener in enumerate(_listeners):
+        _listeners[i] = _start_listener(listener.queue, listener.handlers)
+
+
+os.register_at_fork(after_in_child=_restart_listeners)
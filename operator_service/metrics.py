@@ -0,0 +1,139 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Prometheus metrics, available when prometheus_client is installed
+(operator-service[metrics]). Without it every metric is a no-op.
+With several gunicorn workers, PROMETHEUS_MULTIPROC_DIR must point to an empty
+directory so /metrics aggregates all of them.
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+REQUEST_LATENCY = _metric(
+    "Histogram",
+    "operator_request_duration_seconds",
+    "Time to build the response of a request, streamed bodies excluded",
+    ["endpoint", "method", "status"],
+)
+QUERY_LATENCY = _metric(
+    "Histogram",
+    "operator_pg_query_duration_seconds",
+    "Postgresql query latency",
+    ["query"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+QUERY_ERRORS = _metric(
+    "Counter", "operator_pg_query_errors_total", "Failed Postgresql queries", ["query"]
+)
+POOL_CONNECTIONS_USED = _metric(
+    "Gauge",
+    "operator_pg_pool_connections_used",
+    "Postgresql connections checked out of the worker pools",
+    multiprocess_mode="livesum",
+)
+SIGNER_RECOVERY_LATENCY = _metric(
+    "Histogram",
+    "operator_signer_recovery_duration_seconds",
+    "Time to recover the signer of a provider signature, cache hits excluded",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+DOWNLOAD_BYTES = _metric(
+    "Counter",
+    "operator_download_bytes_total",
+    "Result bytes read from the storage or the result cache by /getResult",
+    ["source"],
+)
+WATCH_CLIENTS = _metric(
+    "Gauge",
+    "operator_watch_clients",
+    "Clients streaming job status updates from /compute/watch",
+    multiprocess_mode="livesum",
+)
+
+
+def _before_request():
+    g.request_start = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        REQUEST_LATENCY.labels(
+            request.endpoint or "unmatched", request.method, response.status_code
+        ).observe(time.perf_counter() - start)
+    return response
+
+
+def metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(
+        prometheus_client.generate_latest(registry),
+        200,
+        content_type=prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
+def init_metrics(app):
+    """
+    Times every request and adds the /metrics endpoint.
+    """
+    if prometheus_client is None:
+        logger.info("prometheus_client is not installed, metrics are disabled")
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
+
+
+def child_exit(server, worker):
+    """
+    gunicorn hook, drops the live gauges of a dead worker in multiprocess mode.
+    """
+    if prometheus_client is not None and "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
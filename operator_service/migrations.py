@@ -0,0 +1,270 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""
+Versioned schema migrations, applied by /pgsqlinit on top of the base tables.
+Applied versions are recorded in schema_migrations, so each migration runs once.
+Add new migrations at the end of MIGRATIONS with the next version number.
+"""
+
+import logging
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# any constant, only serializes concurrent /pgsqlinit calls
+MIGRATIONS_LOCK_ID = 7436621
+
+
+class Index:
+    """
+    An index built with CREATE INDEX CONCURRENTLY, which does not block writes
+    to the table but cannot run inside a transaction.
+    """
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+
+    def apply(self, cursor):
+        # a failed concurrent build leaves an invalid index behind, build it again
+        cursor.execute(
+            """
+            SELECT NOT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %(name)s
+            """,
+            {"name": self.name.lower()},
+        )
+        row = cursor.fetchone()
+        if row and row[0]:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {self.name}")
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.name} ON {self.definition}"
+        )
+
+
+MIGRATIONS = [
+    (
+        1,
+        "one numeric nonce per provider",
+        [
+            # older nonces tables stored nonces as text, possibly with several rows per provider
+            """
+            DELETE FROM nonces a USING nonces b
+            WHERE a.provider = b.provider
+                AND (a.nonce::numeric < b.nonce::numeric
+                    OR (a.nonce::numeric = b.nonce::numeric AND a.ctid < b.ctid))
+            """,
+            "ALTER TABLE nonces ALTER COLUMN nonce TYPE numeric USING nonce::numeric",
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conrelid = 'nonces'::regclass AND contype = 'p'
+                ) THEN
+                    ALTER TABLE nonces ADD PRIMARY KEY (provider);
+                END IF;
+            END
+            $$;
+            """,
+        ],
+    ),
+    (
+        2,
+        "did and chainid columns",
+        [
+            "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS did varchar(255)",
+            "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS chainid varchar(255)",
+        ],
+    ),
+    (
+        3,
+        "algodid and inputdids columns",
+        [
+            "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS algodid varchar(255)",
+            "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS inputdids text[]",
+            # backfill the columns extracted from the workflow for jobs created before
+            # them, create_compute_job stores the request workflow under spec.metadata
+            """
+            UPDATE jobs SET
+                algodid = COALESCE(
+                    workflow::json #>> '{spec,metadata,stages,0,algorithm,id}', 'raw'
+                ),
+                inputdids = ARRAY(
+                    SELECT input.value->>'id'
+                    FROM json_array_elements(
+                        workflow::json #> '{spec,metadata,stages,0,input}'
+                    ) WITH ORDINALITY AS input(value, position)
+                    WHERE input.value->>'id' IS NOT NULL
+                    ORDER BY input.position
+                ),
+                chainid = COALESCE(
+                    chainid, workflow::json #>> '{spec,metadata,chainId}'
+                )
+            WHERE algodid IS NULL AND workflow IS NOT NULL
+            """,
+        ],
+    ),
+    (
+        4,
+        "indexes for job lookups",
+        [
+            # is_agreement_id_in_use
+            Index(
+                "indx_agreementId_running",
+                "jobs (agreementId) WHERE dateFinished IS NULL",
+            ),
+            # get_sql_job_urls, stop and remove by jobId
+            Index("indx_workflowId_jobs", "jobs (workflowId)"),
+            # owner listings, ordered for keyset pagination
+            Index("indx_owner_created_jobs", "jobs (owner, dateCreated, workflowId)"),
+            # running jobs, ordered for keyset pagination
+            Index(
+                "indx_running_jobs",
+                "jobs (dateCreated, workflowId) WHERE dateFinished IS NULL",
+            ),
+            # get_job_by_provider_and_owner
+            Index("indx_provider_owner_jobs", "jobs (provider, owner)"),
+            # announce() picks the jobs waiting in its namespace
+            Index("indx_namespace_waiting_jobs", "jobs (namespace) WHERE status = 1"),
+            # superseded by indx_owner_created_jobs
+            "DROP INDEX CONCURRENTLY IF EXISTS indx_owner_jobs",
+        ],
+    ),
+    (
+        5,
+        "job status notifications",
+        [
+            # payloads are limited to 8000 bytes, outputs are left to GET /compute
+            """
+            CREATE OR REPLACE FUNCTION notify_job_status() RETURNS trigger
+              LANGUAGE plpgsql
+              AS $function$
+              BEGIN
+                PERFORM pg_notify('job_status', json_build_object(
+                    'agreementId', NEW.agreementId,
+                    'jobId', NEW.workflowId,
+                    'owner', NEW.owner,
+                    'status', NEW.status,
+                    'statusText', NEW.statusText,
+                    'dateFinished', extract(epoch from NEW.dateFinished)
+                )::text);
+                RETURN NULL;
+              END
+            $function$;
+            """,
+            "DROP TRIGGER IF EXISTS job_status_notify ON jobs",
+            """
+            CREATE TRIGGER job_status_notify
+              AFTER UPDATE OF status, statusText, dateFinished ON jobs
+              FOR EACH ROW
+              WHEN (OLD.status IS DISTINCT FROM NEW.status
+                OR OLD.statusText IS DISTINCT FROM NEW.statusText
+                OR OLD.dateFinished IS DISTINCT FROM NEW.dateFinished)
+              EXECUTE PROCEDURE notify_job_status()
+            """,
+        ],
+    ),
+    (
+        6,
+        "laststatusupdate follows job changes",
+        [
+            # status ETags are built from laststatusupdate, keep it current for
+            # every column the status endpoints return, unless the writer set it
+            """
+            CREATE OR REPLACE FUNCTION touch_job_status() RETURNS trigger
+              LANGUAGE plpgsql
+              AS $function$
+              BEGIN
+                IF NEW.laststatusupdate IS NOT DISTINCT FROM OLD.laststatusupdate THEN
+                  NEW.laststatusupdate := clock_timestamp();
+                END IF;
+                RETURN NEW;
+              END
+            $function$;
+            """,
+            "DROP TRIGGER IF EXISTS job_status_touch ON jobs",
+            """
+            CREATE TRIGGER job_status_touch
+              BEFORE UPDATE ON jobs
+              FOR EACH ROW
+              WHEN (OLD.status IS DISTINCT FROM NEW.status
+                OR OLD.statusText IS DISTINCT FROM NEW.statusText
+                OR OLD.dateFinished IS DISTINCT FROM NEW.dateFinished
+                OR OLD.outputsURL IS DISTINCT FROM NEW.outputsURL
+                OR OLD.stopreq IS DISTINCT FROM NEW.stopreq
+                OR OLD.removed IS DISTINCT FROM NEW.removed
+                OR OLD.namespace IS DISTINCT FROM NEW.namespace)
+              EXECUTE PROCEDURE touch_job_status()
+            """,
+        ],
+    ),
+]
+
+
+def _apply(connection, cursor, version, description, steps):
+    # migrations with concurrent index builds run in autocommit mode, their
+    # steps are idempotent so they are simply run again if one of them fails
+    concurrent = any(
+        isinstance(step, Index) or "CONCURRENTLY" in step for step in steps
+    )
+    connection.autocommit = concurrent
+    for step in steps:
+        if isinstance(step, Index):
+            step.apply(cursor)
+        else:
+            cursor.execute(step)
+    cursor.execute(
+        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+        (version, description),
+    )
+    if not concurrent:
+        connection.commit()
+
+
+def run_migrations(connection):
+    """
+    Applies the pending migrations, in order, stops at the first failure.
+    :return: errors, empty when the schema is up to date
+    """
+    connection.commit()
+    connection.autocommit = True
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations
+            (
+                version integer PRIMARY KEY,
+                description text,
+                applied_at timestamp without time zone default NOW()
+            )
+            """)
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    except (Exception, psycopg2.Error) as error:
+        cursor.close()
+        return "Error PostgreSQL:" + str(error)
+
+    output = ""
+    try:
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cursor.fetchall()}
+        for version, description, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s: %s", version, description)
+            try:
+                _apply(connection, cursor, version, description, steps)
+            except (Exception, psycopg2.Error) as error:
+                if not connection.autocommit:
+                    connection.rollback()
+                output = f"Error PostgreSQL: migration {version}: {error}"
+                logger.error(output)
+                break
+    finally:
+        connection.autocommit = True
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+        cursor.close()
+    return output
@@ -5,9 +5,13 @@ import os
 
 from flask import Flask
 from flask_cors import CORS
+from operator_service.config import install_reload_handler
+from operator_service.green import patch_psycopg
 from operator_service.log import setup_logging
 
 setup_logging()
+install_reload_handler()
+patch_psycopg()
 
 app = Flask(__name__)
 CORS(app)
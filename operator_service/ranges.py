@@ -0,0 +1,97 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+import uuid
+
+from flask import Response
+from werkzeug.http import parse_date, unquote_etag
+
+
+def get_attachment_headers(filename):
+    """
+    Headers naming the downloaded result, the same whether it is streamed from
+    the storage, served from the result cache or by the front proxy.
+    """
+    return {
+        "Content-Disposition": f"attachment;filename={filename}",
+        "Access-Control-Expose-Headers": "Content-Disposition",
+    }
+
+
+def get_byte_ranges(request_range, length):
+    """
+    :return: list of (start, stop) for the satisfiable ranges of a Range header,
+    an empty list when none of them is (RFC 7233, 416 response)
+    """
+    ranges = []
+    for start, end in request_range.ranges:
+        if end is None:
+            end = length
+        if start < 0:
+            start = max(length + start, 0)
+        end = min(end, length)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+
+def if_range_matches(request, etag, last_modified):
+    """
+    Whether the Range header applies, given the If-Range header of the request
+    and the validators of the representation.
+    """
+    if not request.headers.get("If-Range"):
+        return True
+    if_range = request.if_range
+    if if_range.etag:
+        if not etag:
+            return False
+        tag, weak = unquote_etag(etag)
+        return not weak and tag == if_range.etag
+    if if_range.date and last_modified:
+        return if_range.date == parse_date(last_modified)
+    return False
+
+
+def slice_chunks(chunks, start, stop):
+    """
+    Yields bytes [start, stop) of a stream of chunks.
+    """
+    offset = 0
+    for chunk in chunks:
+        chunk_start = offset
+        offset += len(chunk)
+        if offset <= start:
+            continue
+        yield chunk[max(start - chunk_start, 0) : stop - chunk_start]
+        if offset >= stop:
+            break
+
+
+def range_not_satisfiable_response(length):
+    return Response(b"", 416, headers={"Content-Range": f"bytes */{length}"})
+
+
+def multipart_byteranges_response(read_range, ranges, length, content_type, headers):
+    """
+    206 response with one multipart/byteranges part for each range,
+    read_range(start, stop) yields the bytes of a range.
+    """
+    boundary = uuid.uuid4().hex
+
+    def _generate():
+        for start, stop in ranges:
+            part_headers = f"\r\n--{boundary}\r\n"
+            if content_type:
+                part_headers += f"Content-Type: {content_type}\r\n"
+            part_headers += f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n"
+            yield part_headers.encode("latin-1")
+            yield from read_range(start, stop)
+        yield f"\r\n--{boundary}--\r\n".encode("latin-1")
+
+    return Response(
+        _generate(),
+        206,
+        headers=headers,
+        content_type=f"multipart/byteranges; boundary={boundary}",
+    )
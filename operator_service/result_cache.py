@@ -0,0 +1,214 @@
+#  Copyright 2023 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from flask import send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_date, unquote_etag
+
+from operator_service.metrics import DOWNLOAD_BYTES
+from operator_service.ranges import (
+    get_attachment_headers,
+    get_byte_ranges,
+    if_range_matches,
+    multipart_byteranges_response,
+    range_not_satisfiable_response,
+)
+
+logger = logging.getLogger(__name__)
+
+DATA_SUFFIX = ".data"
+META_SUFFIX = ".json"
+
+
+def get_cache_dir():
+    """
+    Results are cached only when RESULT_CACHE_DIR is set, it can be a volume
+    shared by all workers of a pod.
+    """
+    return os.getenv("RESULT_CACHE_DIR")
+
+
+def get_cache_max_size():
+    return int(os.getenv("RESULT_CACHE_MAX_SIZE", 10 * 1024 * 1024 * 1024))
+
+
+def _get_cache_path(cache_dir, job_id, index):
+    # job id comes from the request, never use it in a path as it is
+    key = hashlib.sha256(f"{job_id}/{index}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key)
+
+
+def get_cached_result(job_id, index):
+    """
+    :return: (data file path, metadata dict) if the result is cached, else None
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+    path = _get_cache_path(cache_dir, job_id, index)
+    try:
+        with open(path + META_SUFFIX, "rt") as f:
+            meta = json.load(f)
+        # mtime of the metadata file is the last use, for LRU eviction. The data
+        # file keeps its mtime, it may be used as Last-Modified
+        os.utime(path + META_SUFFIX)
+    except (OSError, ValueError):
+        return None
+    return path + DATA_SUFFIX, meta
+
+
+def send_cached_result(cached, request):
+    """
+    Sends a cached result, answering single and multiple range requests.
+    Validators sent by the storage when the result was cached are kept, so
+    clients can resume with If-Range whether the result is cached or not.
+    """
+    path, meta = cached
+    size = os.path.getsize(path)
+    etag = meta.get("etag")
+    last_modified = meta.get("last_modified")
+    request_range = request.range
+    if (
+        request_range
+        and request_range.units == "bytes"
+        and len(request_range.ranges) > 1
+        and if_range_matches(request, etag, last_modified)
+    ):
+        ranges = get_byte_ranges(request_range, size)
+        if not ranges:
+            return range_not_satisfiable_response(size)
+
+        def _read_range(start, stop):
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    DOWNLOAD_BYTES.labels("cache").inc(len(chunk))
+                    yield chunk
+
+        headers = get_attachment_headers(meta["filename"])
+        headers["Accept-Ranges"] = "bytes"
+        if etag:
+            headers["ETag"] = etag
+        if last_modified:
+            headers["Last-Modified"] = last_modified
+        return multipart_byteranges_response(
+            _read_range, ranges, size, meta.get("content_type"), headers
+        )
+
+    tag, weak = unquote_etag(etag) if etag else (None, None)
+    try:
+        response = send_file(
+            path,
+            mimetype=meta.get("content_type"),
+            as_attachment=True,
+            download_name=meta["filename"],
+            conditional=True,
+            # send_file only sends strong etags, otherwise it computes its own
+            etag=tag if tag and not weak else True,
+            last_modified=parse_date(last_modified) if last_modified else None,
+        )
+    except RequestedRangeNotSatisfiable:
+        return range_not_satisfiable_response(size)
+    # send_file formats Content-Disposition its own way
+    response.headers.update(get_attachment_headers(meta["filename"]))
+    DOWNLOAD_BYTES.labels("cache").inc(response.content_length or 0)
+    return response
+
+
+def cache_while_streaming(chunks, job_id, index, meta, size=None):
+    """
+    Yields chunks as they come while writing them to a temporary file, which
+    becomes the cached result once the whole content went through.
+    :param meta: filename, content_type, etag and last_modified of the result
+    """
+    cache_dir = get_cache_dir()
+    if not cache_dir or (size is not None and size > get_cache_max_size()):
+        yield from chunks
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False)
+    except OSError as e:
+        logger.warning(f"Result cache disabled, cannot write to {cache_dir}: {e}")
+        yield from chunks
+        return
+
+    written = 0
+    complete = False
+    try:
+        for chunk in chunks:
+            if tmp is not None:
+                try:
+                    tmp.write(chunk)
+                    written += len(chunk)
+                except OSError as e:
+                    logger.warning(f"Failed caching result {job_id}/{index}: {e}")
+                    tmp.close()
+                    os.unlink(tmp.name)
+                    tmp = None
+            yield chunk
+        complete = True
+    finally:
+        if tmp is not None:
+            tmp.close()
+            if complete and (size is None or size == written):
+                _store(tmp.name, job_id, index, meta)
+            else:
+                os.unlink(tmp.name)
+
+
+def _store(tmp_path, job_id, index, meta):
+    path = _get_cache_path(get_cache_dir(), job_id, index)
+    try:
+        os.replace(tmp_path, path + DATA_SUFFIX)
+        with open(path + META_SUFFIX + ".tmp", "wt") as f:
+            json.dump(meta, f)
+        os.replace(path + META_SUFFIX + ".tmp", path + META_SUFFIX)
+    except OSError as e:
+        logger.warning(f"Failed caching result {job_id}/{index}: {e}")
+        return
+    evict()
+
+
+def evict():
+    """
+    Removes the least recently used results until the cache fits in
+    RESULT_CACHE_MAX_SIZE bytes.
+    """
+    cache_dir = get_cache_dir()
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(DATA_SUFFIX):
+                continue
+            key = entry.path[: -len(DATA_SUFFIX)]
+            try:
+                size = entry.stat().st_size
+                last_used = os.stat(key + META_SUFFIX).st_mtime
+            except FileNotFoundError:
+                continue
+            entries.append((last_used, size, key))
+            total += size
+
+    max_size = get_cache_max_size()
+    for _, size, key in sorted(entries):
+        if total <= max_size:
+            break
+        for file_path in [key + META_SUFFIX, key + DATA_SUFFIX]:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+        total -= size
@@ -1,36 +1,52 @@
+import itertools
 import os
 from os import path
 import logging
-import json
 
 import kubernetes
 from flask import Blueprint, request, Response
 
 
+from operator_service import json_codec as json
 from operator_service.data_store import (
     create_sql_job,
     get_sql_status,
-    get_sql_jobs,
-    stop_sql_job,
-    remove_sql_job,
-    get_sql_running_jobs,
+    iter_sql_status,
+    stop_sql_jobs,
+    remove_sql_jobs,
+    iter_sql_running_jobs,
+    is_agreement_id_in_use,
     get_sql_job_urls,
-    get_sql_environments,
+    get_cached_environments,
+    get_cached_environments_fingerprint,
+    get_sql_running_jobs_fingerprint,
+    get_sql_status_fingerprint,
     check_environment_exists,
     get_job_by_provider_and_owner,
 )
+from operator_service.exceptions import DatabaseUnavailableError
+from operator_service.green import is_gevent_patched
+from operator_service.job_events import (
+    stream_job_events,
+    subscribe,
+    unsubscribe,
+)
 from operator_service.utils import (
     create_compute_job,
     check_required_attributes,
-    sanitize_response_for_provider,
+    encode_for_provider,
     generate_new_id,
     process_provider_signature_validation,
     get_compute_resources,
     get_namespace_configs,
     build_download_response,
+    get_requests_session,
+    get_pagination_params,
+    get_page_cursor,
+    stream_json_list,
+    get_weak_etag,
+    conditional_response,
 )
-from requests.adapters import HTTPAdapter
-from requests.sessions import Session
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +55,19 @@ services = Blueprint("services", __name__)
 standard_headers = {"Content-type": "application/json", "Connection": "close"}
 
 
+@services.errorhandler(DatabaseUnavailableError)
+def database_unavailable(error):
+    # no pooled connection: fail the request rather than answer without the database
+    logger.error(f"Database unavailable: {error}")
+    headers = dict(standard_headers)
+    headers["Retry-After"] = "1"
+    return Response(
+        json.dumps({"error": "Database unavailable, try again later"}),
+        503,
+        headers=headers,
+    )
+
+
 @services.route("/compute", methods=["POST"])
 def start_compute_job():
     """
@@ -154,17 +183,14 @@ def start_compute_job():
     workflow["chainId"] = data.get("chainId")
 
     try:
-        active_jobs = get_sql_running_jobs()
-        logger.info(f"active_jobs: {active_jobs}")
-        for job in active_jobs:
-            if job["agreementId"] == agreement_id:
-                return Response(
-                    json.dumps(
-                        {"error": f"`agreementId` already in use for other job."}
-                    ),
-                    400,
-                    headers=standard_headers,
-                )
+        if is_agreement_id_in_use(agreement_id):
+            return Response(
+                json.dumps({"error": f"`agreementId` already in use for other job."}),
+                400,
+                headers=standard_headers,
+            )
+    except DatabaseUnavailableError:
+        raise
     except Exception as e:
         msg = f"Error getting the active jobs for initializing a compute job: {e}"
         logger.error(msg)
@@ -207,17 +233,20 @@ def start_compute_job():
                 headers=standard_headers,
             )
     job_id = generate_new_id()
-    logger.info(f"Got job_id: {job_id}")
+    logger.info("Got job_id: %s", job_id)
     body = create_compute_job(workflow, job_id, environment)
     body["metadata"]["secret"] = generate_new_id()
-    logger.debug(f"Got body: {body}")
-    create_sql_job(
+    logger.debug("Got body: %s", body)
+    job = create_sql_job(
         agreement_id, str(job_id), owner, body, environment, provider_address
     )
-    status_list = get_sql_status(agreement_id, str(job_id), owner, workflow["chainId"])
+    if job is None:
+        msg = f"Failed to create job {job_id}"
+        logger.error(msg)
+        return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
 
     return Response(
-        json.dumps(sanitize_response_for_provider(status_list)),
+        encode_for_provider([job]),
         200,
         headers=standard_headers,
     )
@@ -296,18 +325,15 @@ def stop_compute_job():
             return Response(
                 json.dumps({"error": msg}), status, headers=standard_headers
             )
-        jobs_list = get_sql_jobs(agreement_id, job_id, owner)
-        for ajob in jobs_list:
-            name = ajob
-            logger.info(f"Stopping job : {name}")
-            stop_sql_job(name)
-
-        status_list = sanitize_response_for_provider(
-            get_sql_status(agreement_id, job_id, owner, chain_id)
-        )
+        stopped_jobs = stop_sql_jobs(agreement_id, job_id, owner)
+        logger.info("Stopping jobs : %s", stopped_jobs)
+
+        status_list = get_sql_status(agreement_id, job_id, owner, chain_id)
 
-        return Response(json.dumps(status_list), 200, headers=standard_headers)
+        return Response(encode_for_provider(status_list), 200, headers=standard_headers)
 
+    except DatabaseUnavailableError:
+        raise
     except Exception as e:
         msg = f"Exception when stopping compute job: {e}"
         logger.error(msg)
@@ -344,9 +370,46 @@ def delete_compute_job():
         in: query
         description: providerSignature
         type: string
+      - name: nonce
+        in: query
+        description: nonce
+    responses:
+      200:
+        description: Status of the removed jobs
+      400:
+        description: Error
     """
-    # since op-engine handles this, there is no need for this endpoint. Will just keep it here for backwards compat
-    return Response(json.dumps(""), 200, headers=standard_headers)
+    try:
+        data = request.args if request.args else request.json
+        required_attributes = ["owner", "providerSignature", "nonce"]
+        msg, status = check_required_attributes(
+            required_attributes, data, "DELETE:/compute"
+        )
+        if msg:
+            return Response(
+                json.dumps({"error": msg}), status, headers=standard_headers
+            )
+        job_filter, error_response = get_status_request_filter(data)
+        if error_response:
+            return error_response
+        agreement_id, job_id, owner, chain_id = job_filter
+
+        error_response = check_status_request_signature(data, job_id, owner)
+        if error_response:
+            return error_response
+        removed_jobs = remove_sql_jobs(agreement_id, job_id, owner)
+        logger.info("Removing jobs : %s", removed_jobs)
+
+        status_list = get_sql_status(agreement_id, job_id, owner, chain_id)
+
+        return Response(encode_for_provider(status_list), 200, headers=standard_headers)
+
+    except DatabaseUnavailableError:
+        raise
+    except Exception as e:
+        msg = f"Exception when removing compute job: {e}"
+        logger.error(msg)
+        return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
 
 
 @services.route("/compute", methods=["GET"])
@@ -378,6 +441,14 @@ def get_compute_job_status():
       - name: nonce
         in: query
         description: nonce
+      - name: limit
+        in: query
+        description: maximum number of jobs to return, enables pagination
+        type: integer
+      - name: cursor
+        in: query
+        description: X-Next-Cursor header of the previous page
+        type: string
     responses:
       200:
         description: Get correctly the status
@@ -386,59 +457,179 @@ def get_compute_job_status():
     """
     try:
         data = request.args if request.args else request.json
-        if data is None:
-            msg = f"You have to specify one of agreementId, jobId or owner"
-            return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
-        agreement_id = data.get("agreementId", None)
-        owner = data.get("owner", None)
-        job_id = data.get("jobId", None)
-        chain_id = data.get("chainId", None)
-
-        if not agreement_id or len(agreement_id) < 2:
-            agreement_id = None
+        job_filter, error_response = get_status_request_filter(data)
+        if error_response:
+            return error_response
+        agreement_id, job_id, owner, chain_id = job_filter
 
-        if not job_id or len(job_id) < 2:
-            job_id = None
-
-        if not owner or len(owner) < 2:
-            owner = None
-
-        if owner is None and agreement_id is None and job_id is None:
-            msg = f"You have to specify one of agreementId, jobId or owner"
-            logger.error(msg)
+        limit, after, msg = get_pagination_params(data)
+        if msg:
             return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
 
-        nonce = data.get("nonce", None)
-        # verify provider's signature
-        if job_id:
-            sign_message = f"{owner}{job_id}"
-        else:
-            sign_message = f"{owner}"
-        logger.info(
-            f"route get status process signature\nproviderSignature: {data.get('providerSignature')}\nsign_message: {sign_message}\nnonce to compare: {nonce}"
+        error_response = check_status_request_signature(data, job_id, owner)
+        if error_response:
+            return error_response
+        logger.info("Got status request for %s, %s, %s", agreement_id, job_id, owner)
+        etag = get_weak_etag(
+            get_sql_status_fingerprint(agreement_id, job_id, owner, chain_id),
+            agreement_id,
+            job_id,
+            owner,
+            chain_id,
+            limit,
+            after,
         )
-        msg, status, provider_address = process_provider_signature_validation(
-            data.get("providerSignature"), sign_message, nonce
-        )
-        if msg:
-            return Response(
-                json.dumps({"error": msg}), status, headers=standard_headers
-            )
-        logger.info(f"Got status request for {agreement_id}, {job_id}, {owner}")
-        api_response = get_sql_status(agreement_id, job_id, owner, chain_id)
-
-        return Response(
-            json.dumps(sanitize_response_for_provider(api_response)),
-            200,
-            headers=standard_headers,
+        return conditional_response(
+            etag,
+            lambda: build_job_list_response(
+                lambda page_limit: iter_sql_status(
+                    agreement_id, job_id, owner, chain_id, page_limit, after
+                ),
+                limit,
+            ),
         )
 
+    except DatabaseUnavailableError:
+        raise
     except Exception as e:
         msg = f"Error getting the status: {e}"
         logger.error(msg)
         return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
 
 
+@services.route("/compute/watch", methods=["GET"])
+def watch_compute_job_status():
+    """
+    Stream status changes of an specific or multiple jobs (Server-Sent Events).
+    A `status` event is sent with the current status of each job, then an
+    `update` event (agreementId, jobId, owner, status, statusText, dateFinished)
+    each time one of them changes. The stream ends after WATCH_MAX_DURATION
+    seconds, clients reconnect with a new signature.
+    ---
+    tags:
+      - operation
+    consumes:
+      - application/json
+    produces:
+      - text/event-stream
+    parameters:
+      - name: agreementId
+        in: query
+        description: agreementId
+        type: string
+      - name: jobId
+        in: query
+        description: Id of the job.
+        type: string
+      - name: owner
+        in: query
+        description: owner
+        type: string
+      - name: providerSignature
+        in: query
+        description: providerSignature
+        type: string
+      - name: nonce
+        in: query
+        description: nonce
+    responses:
+      200:
+        description: Stream of status events
+      400:
+        description: Error
+      501:
+        description: Not served by sync workers
+    """
+    if not is_gevent_patched():
+        # a sync worker would be held by the stream for WATCH_MAX_DURATION
+        msg = "Watching jobs needs async workers (OPERATOR_WORKER_CLASS=gevent)"
+        logger.error(msg)
+        return Response(json.dumps({"error": msg}), 501, headers=standard_headers)
+    try:
+        data = request.args if request.args else request.json
+        job_filter, error_response = get_status_request_filter(data)
+        if error_response:
+            return error_response
+        agreement_id, job_id, owner, chain_id = job_filter
+
+        error_response = check_status_request_signature(data, job_id, owner)
+        if error_response:
+            return error_response
+        logger.info("Got watch request for %s, %s, %s", agreement_id, job_id, owner)
+        events = subscribe(agreement_id, job_id, owner)
+    except DatabaseUnavailableError:
+        raise
+    except Exception as e:
+        msg = f"Error watching the status: {e}"
+        logger.error(msg)
+        return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
+
+    response = Response(
+        stream_job_events(
+            events, lambda: get_sql_status(agreement_id, job_id, owner, chain_id)
+        ),
+        200,
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # the stream generator cleans up too, unless the client left before it started
+    response.call_on_close(lambda: unsubscribe(events))
+    return response
+
+
+def get_status_request_filter(data):
+    """
+    :return: ((agreement_id, job_id, owner, chain_id), None), or (None, error
+    response) when none of agreementId, jobId or owner is given
+    """
+    if data is None:
+        msg = f"You have to specify one of agreementId, jobId or owner"
+        return None, Response(json.dumps({"error": msg}), 400, headers=standard_headers)
+    agreement_id = data.get("agreementId", None)
+    owner = data.get("owner", None)
+    job_id = data.get("jobId", None)
+    chain_id = data.get("chainId", None)
+
+    if not agreement_id or len(agreement_id) < 2:
+        agreement_id = None
+
+    if not job_id or len(job_id) < 2:
+        job_id = None
+
+    if not owner or len(owner) < 2:
+        owner = None
+
+    if owner is None and agreement_id is None and job_id is None:
+        msg = f"You have to specify one of agreementId, jobId or owner"
+        logger.error(msg)
+        return None, Response(json.dumps({"error": msg}), 400, headers=standard_headers)
+    return (agreement_id, job_id, owner, chain_id), None
+
+
+def check_status_request_signature(data, job_id, owner):
+    """
+    :return: error response if the provider signature is not valid, else None
+    """
+    nonce = data.get("nonce", None)
+    # verify provider's signature
+    if job_id:
+        sign_message = f"{owner}{job_id}"
+    else:
+        sign_message = f"{owner}"
+    logger.debug(
+        "route get status process signature\nproviderSignature: %s\nsign_message: %s\nnonce to compare: %s",
+        data.get("providerSignature"),
+        sign_message,
+        nonce,
+    )
+    msg, status, provider_address = process_provider_signature_validation(
+        data.get("providerSignature"), sign_message, nonce
+    )
+    if msg:
+        return Response(json.dumps({"error": msg}), status, headers=standard_headers)
+    return None
+
+
 @services.route("/runningjobs", methods=["GET"])
 def get_running_jobs():
     """
@@ -448,13 +639,32 @@ def get_running_jobs():
       - operation
     consumes:
       - application/json
+    parameters:
+      - name: limit
+        in: query
+        description: maximum number of jobs to return, enables pagination
+        type: integer
+      - name: cursor
+        in: query
+        description: X-Next-Cursor header of the previous page
+        type: string
     responses:
       200:
         description: Get correctly the status
     """
     try:
-        api_response = sanitize_response_for_provider(get_sql_running_jobs())
-        return Response(json.dumps(api_response), 200, headers=standard_headers)
+        limit, after, msg = get_pagination_params(request.args)
+        if msg:
+            return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
+        etag = get_weak_etag(get_sql_running_jobs_fingerprint(), limit, after)
+        return conditional_response(
+            etag,
+            lambda: build_job_list_response(
+                lambda page_limit: iter_sql_running_jobs(page_limit, after), limit
+            ),
+        )
+    except DatabaseUnavailableError:
+        raise
     except Exception as e:
         msg = f"Error getting running jobs: {e}"
         logger.error(msg)
@@ -524,8 +734,8 @@ def get_indexed_result():
         index = int(index)
         outputs, output_owner = get_sql_job_urls(job_id)
         # check owner & provider
-        logger.info(f"Got {output_owner}")
-        logger.info(f"Got {outputs}")
+        logger.debug("Got %s", output_owner)
+        logger.debug("Got %s", outputs)
         if owner != output_owner:
             msg = f"Owner {owner} mismatch for job {job_id}"
             return Response(json.dumps({"error": msg}), 404, headers=standard_headers)
@@ -533,7 +743,7 @@ def get_indexed_result():
         wanted_jobs = get_job_by_provider_and_owner(
             owner=owner, provider=provider_address
         )
-        logger.info(f"Got jobs by owner and provider: {wanted_jobs}")
+        logger.debug("Got jobs by owner and provider: %s", wanted_jobs)
         if wanted_jobs is None:
             msg = f"Provider {provider_address} mismatch for job {job_id}"
             return Response(json.dumps({"error": msg}), 404, headers=standard_headers)
@@ -542,18 +752,24 @@ def get_indexed_result():
             msg = f"No results for job {job_id}"
             return Response(json.dumps({"error": msg}), 404, headers=standard_headers)
         # check the index
-        logger.info(f"Len outputs {len(outputs)}, index: {index}")
+        logger.debug("Len outputs %s, index: %s", len(outputs), index)
         if int(index) < 0:
             msg = f"Negative index {index}"
             return Response(json.dumps({"error": msg}), 404, headers=standard_headers)
         if int(index) >= len(outputs):
             msg = f"No such index {index} in this compute job"
             return Response(json.dumps({"error": msg}), 404, headers=standard_headers)
-        logger.info(f"Trying: {outputs[index]['url']}")
+        logger.info("Trying: %s", outputs[index]["url"])
         return build_download_response(
-            request, requests_session, outputs[index]["url"], None
+            request,
+            requests_session,
+            outputs[index]["url"],
+            None,
+            cache_key=(job_id, index),
         )
 
+    except DatabaseUnavailableError:
+        raise
     except Exception as e:
         msg = f"Error getResult: {e}"
         logger.error(msg)
@@ -575,24 +791,46 @@ def get_environments():
     """
     try:
         data = request.args if request.args else request.json
-        api_response = get_sql_environments(logger, data.get("chainId"))
-        return Response(json.dumps(api_response), 200, headers=standard_headers)
+        chain_id = data.get("chainId")
+        etag = get_weak_etag(get_cached_environments_fingerprint(), chain_id)
+        return conditional_response(
+            etag,
+            lambda: Response(
+                json.dumps(get_cached_environments(chain_id)),
+                200,
+                headers=standard_headers,
+            ),
+        )
+    except DatabaseUnavailableError:
+        raise
     except Exception as e:
         msg = f"{e}"
         logger.error(msg)
         return Response(json.dumps({"error": msg}), 400, headers=standard_headers)
 
 
-def get_requests_session() -> Session:
+def build_job_list_response(get_jobs, limit):
     """
-    Set connection pool maxsize and block value to avoid `connection pool full` warnings.
-    :return: requests session
+    Streams a list of jobs as a JSON array.
+    When paginating, one extra job is read to know whether there is a next page,
+    its cursor is sent in the X-Next-Cursor header.
+    :param get_jobs: function returning an iterator of jobs, given a row limit
     """
-    session = Session()
-    session.mount(
-        "http://", HTTPAdapter(pool_connections=25, pool_maxsize=25, pool_block=True)
-    )
-    session.mount(
-        "https://", HTTPAdapter(pool_connections=25, pool_maxsize=25, pool_block=True)
-    )
-    return session
+    if limit is None:
+        # run the query and fetch its first batch before answering, so a failing
+        # query gets an error status instead of a truncated 200 list
+        jobs = iter(get_jobs(None))
+        first = list(itertools.islice(jobs, 1))
+        return Response(
+            stream_json_list(itertools.chain(first, jobs)),
+            200,
+            headers=standard_headers,
+        )
+
+    jobs = list(get_jobs(limit + 1))
+    headers = dict(standard_headers)
+    if len(jobs) > limit:
+        jobs = jobs[:limit]
+        headers["X-Next-Cursor"] = get_page_cursor(jobs[-1])
+        headers["Access-Control-Expose-Headers"] = "X-Next-Cursor"
+    return Response(stream_json_list(jobs), 200, headers=headers)
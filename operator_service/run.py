@@ -8,6 +8,7 @@ from flask_swagger import swagger
 from flask_swagger_ui import get_swaggerui_blueprint
 
 from operator_service.constants import BaseURLs, ConfigSections, Metadata
+from operator_service.metrics import init_metrics
 from operator_service.myapp import app
 from operator_service.routes import services
 from operator_service.admin_routes import adminpg_services
@@ -53,6 +54,7 @@ swaggerui_blueprint = get_swaggerui_blueprint(
 app.register_blueprint(swaggerui_blueprint, url_prefix=BaseURLs.SWAGGER_URL)
 app.register_blueprint(services, url_prefix=BaseURLs.BASE_OPERATOR_URL)
 app.register_blueprint(adminpg_services, url_prefix=BaseURLs.BASE_OPERATOR_URL)
+init_metrics(app)
 
 if __name__ == "__main__":
     app.run(port=8050)
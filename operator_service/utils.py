@@ -1,25 +1,48 @@
-from decimal import Decimal
-import json
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+import hashlib
+from http.cookiejar import DefaultCookiePolicy
 import os
 import uuid
 import logging
 import mimetypes
+import threading
 from cgi import parse_header
 from os import getenv
 
 from eth_keys import KeyAPI
-from eth_keys.backends import NativeECCBackend
+from eth_keys.backends import get_backend
 from flask import Response, request
+from requests.adapters import HTTPAdapter
+from requests.sessions import Session
+from urllib3.util.retry import Retry
 
+from operator_service import json_codec as json
 from operator_service.data_store import (
     get_nonce_for_certain_provider,
     update_nonce_for_a_certain_provider,
 )
+from operator_service.config import allowed_admins, allowed_providers
 from operator_service.exceptions import InvalidSignatureError
+from operator_service.metrics import DOWNLOAD_BYTES, SIGNER_RECOVERY_LATENCY
+from operator_service.ranges import (
+    get_attachment_headers,
+    get_byte_ranges,
+    if_range_matches,
+    range_not_satisfiable_response,
+    slice_chunks,
+)
+from operator_service.result_cache import (
+    cache_while_streaming,
+    get_cached_result,
+    send_cached_result,
+)
 from web3 import Web3
 
 logger = logging.getLogger(__name__)
-keys = KeyAPI(NativeECCBackend)
+# coincurve when installed (operator-service[coincurve]), pure-Python otherwise,
+# the ECC_BACKEND_CLASS env var selects a backend explicitly
+keys = KeyAPI(get_backend())
 
 
 def generate_new_id():
@@ -45,7 +68,7 @@ def create_compute_job(workflow, execution_id, namespace):
 
 
 def check_required_attributes(required_attributes, data, method):
-    logger.debug("got %s request: %s" % (method, data))
+    logger.debug("got %s request: %s", method, data)
     if not data or not isinstance(data, dict):
         logger.error("%s request failed: data is empty." % method)
         return "payload seems empty.", 400
@@ -60,9 +83,12 @@ def check_required_attributes(required_attributes, data, method):
     return None, None
 
 
+@lru_cache(maxsize=int(os.getenv("SIGNER_CACHE_SIZE", 4096)))
 def get_signer(signature, message):
     """
     Returns signer of a message.
+    Recovered addresses are kept in a LRU cache of SIGNER_CACHE_SIZE entries,
+    hits and misses are reported by get_signer.cache_info().
     """
 
     signature_bytes = Web3.toBytes(hexstr=signature)
@@ -81,26 +107,45 @@ def get_signer(signature, message):
     signable_hash = Web3.solidityKeccak(
         ["bytes", "bytes"], [Web3.toBytes(text=prefix), Web3.toBytes(message_hash)]
     )
-    vkey = keys.ecdsa_recover(signable_hash, signature)
+    with SIGNER_RECOVERY_LATENCY.time():
+        vkey = keys.ecdsa_recover(signable_hash, signature)
     return vkey.to_address()
 
 
+def is_valid_nonce(nonce):
+    # nonces are compared as numeric by Postgresql, anything else is a client error
+    if nonce is None:
+        return False
+    try:
+        return Decimal(str(nonce)).is_finite()
+    except InvalidOperation:
+        return False
+
+
 def process_provider_signature_validation(signature, original_msg, nonce):
+    if not is_valid_nonce(nonce):
+        return f"`nonce` must be a number, got {nonce}.", 400, None
+
     try:
         address = get_signer(signature, original_msg)
     except Exception as e:
         return "Failed to recover address", 400, None
 
-    db_nonce = get_nonce_for_certain_provider(address)
-
-    if db_nonce and nonce <= db_nonce:
+    nonce_accepted = update_nonce_for_a_certain_provider(nonce, address)
+    if nonce_accepted is None:
+        # the nonce could not be checked (e.g. nonces table not migrated yet),
+        # replay protection must not be skipped
+        msg = f"Could not check the nonce of {address}, try again later."
+        logger.error(msg)
+        return msg, 503, None
+    if not nonce_accepted:
+        # only read the stored nonce to report it, the check itself is atomic
+        db_nonce = get_nonce_for_certain_provider(address)
         msg = (
             f"Invalid signature expected nonce ({db_nonce}) > current nonce ({nonce})."
         )
         logger.error(msg)
         raise InvalidSignatureError(msg)
-    else:
-        update_nonce_for_a_certain_provider(nonce, address)
 
     if not signature or not original_msg:
         return f"`providerSignature` of agreementId is required.", 400, None
@@ -108,8 +153,7 @@ def process_provider_signature_validation(signature, original_msg, nonce):
 
     if is_verify_signature_required():
         # verify provider's signature
-        allowed_providers = get_list_of_allowed_providers()
-        if address.lower() not in allowed_providers:
+        if address not in allowed_providers:
             msg = (
                 f"Invalid signature {signature} of documentId {original_msg},"
                 f"the signing ethereum account {address} is not authorized to use this service."
@@ -120,17 +164,7 @@ def process_provider_signature_validation(signature, original_msg, nonce):
 
 
 def get_list_of_allowed_providers():
-    try:
-        config_allowed_list = json.loads(os.getenv("ALLOWED_PROVIDERS"))
-        if not isinstance(config_allowed_list, list):
-            logger.error("Failed loading ALLOWED_PROVIDERS")
-            return []
-        return config_allowed_list
-    except Exception as e:
-        logging.error(
-            f'Exception when calling json.loads(os.getenv("ALLOWED_PROVIDERS")): {e}'
-        )
-        return []
+    return allowed_providers.get()
 
 
 def is_verify_signature_required():
@@ -158,15 +192,148 @@ def get_namespace_configs():
     return resources
 
 
-def build_download_response(request, requests_session, url, content_type=None):
+_requests_session = None
+_requests_session_pid = None
+_requests_session_lock = threading.Lock()
+
+
+def _get_download_adapter(pool_maxsize):
+    retry = Retry(
+        total=int(os.getenv("DOWNLOAD_RETRIES", 2)),
+        backoff_factor=float(os.getenv("DOWNLOAD_RETRY_BACKOFF", 0.2)),
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    return HTTPAdapter(
+        pool_connections=int(os.getenv("DOWNLOAD_POOL_CONNECTIONS", 25)),
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+        max_retries=retry,
+    )
+
+
+def get_requests_session() -> Session:
+    """
+    Process wide requests session, so connections to the storage hosts are kept
+    alive between downloads. Each forked worker builds its own, it never keeps
+    cookies.
+    Pool size is DOWNLOAD_POOL_MAXSIZE connections per host, overridden for some
+    hosts by DOWNLOAD_POOL_HOSTS, e.g. {"https://ipfs.example.com": 100}
+    :return: requests session
+    """
+    global _requests_session, _requests_session_pid
+    pid = os.getpid()
+    if _requests_session is not None and _requests_session_pid == pid:
+        return _requests_session
+    with _requests_session_lock:
+        if _requests_session is None or _requests_session_pid != pid:
+            pool_maxsize = int(os.getenv("DOWNLOAD_POOL_MAXSIZE", 25))
+            session = Session()
+            # the session is shared by all the consumers, cookies set by the
+            # storage of one download must not be sent along with the next ones
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount("http://", _get_download_adapter(pool_maxsize))
+            session.mount("https://", _get_download_adapter(pool_maxsize))
+            try:
+                pool_hosts = json.loads(os.getenv("DOWNLOAD_POOL_HOSTS", "{}"))
+            except ValueError as e:
+                logger.error(f"Failed loading DOWNLOAD_POOL_HOSTS: {e}")
+                pool_hosts = dict()
+            for prefix, host_pool_maxsize in pool_hosts.items():
+                session.mount(prefix, _get_download_adapter(int(host_pool_maxsize)))
+            _requests_session = session
+            _requests_session_pid = pid
+    return _requests_session
+
+
+def get_download_timeout():
+    """
+    (connect, read) timeouts in seconds for result downloads
+    """
+    return (
+        float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", 3)),
+        float(os.getenv("DOWNLOAD_READ_TIMEOUT", 3)),
+    )
+
+
+def get_download_filename(url, content_type, content_disposition=None):
+    filename = url.split("/")[-1]
+    if content_disposition:
+        _, content_disposition_params = parse_header(content_disposition)
+        content_filename = content_disposition_params.get("filename")
+        if content_filename:
+            filename = content_filename
+
+    file_ext = os.path.splitext(filename)[1]
+    if file_ext and not content_type:
+        content_type = mimetypes.guess_type(filename)[0]
+    elif not file_ext and content_type:
+        # add an extension to filename based on the content_type
+        extension = mimetypes.guess_extension(content_type)
+        if extension:
+            filename = filename + extension
+    return filename, content_type
+
+
+def get_accel_redirect(url):
+    """
+    When DOWNLOAD_ACCEL_HEADER (X-Accel-Redirect for nginx, X-Sendfile for apache)
+    is set and the url starts with one of the DOWNLOAD_ACCEL_MAP prefixes,
+    returns the header and the location the front proxy serves the file from.
+    """
+    header = os.getenv("DOWNLOAD_ACCEL_HEADER")
+    if not header:
+        return None, None
+    try:
+        accel_map = json.loads(os.getenv("DOWNLOAD_ACCEL_MAP", "{}"))
+    except ValueError as e:
+        logger.error(f"Failed loading DOWNLOAD_ACCEL_MAP: {e}")
+        return None, None
+    for prefix, location in accel_map.items():
+        if url.startswith(prefix):
+            return header, location + url[len(prefix) :]
+    return None, None
+
+
+def build_download_response(
+    request, requests_session, url, content_type=None, cache_key=None
+):
+    """
+    Streams the file at url to the client.
+    :param cache_key: (jobId, index) of the result, to serve it from / keep it in
+    the local result cache when RESULT_CACHE_DIR is set
+    """
     try:
         download_request_headers = {}
-        download_response_headers = {}
         is_range_request = bool(request.range)
 
+        accel_header, accel_location = get_accel_redirect(url)
+        if accel_header:
+            # the front proxy serves the file, including range requests
+            filename, content_type = get_download_filename(url, content_type)
+            accel_headers = get_attachment_headers(filename)
+            accel_headers[accel_header] = accel_location
+            return Response(
+                b"",
+                200,
+                headers=accel_headers,
+                content_type=content_type,
+            )
+
+        if cache_key:
+            cached = get_cached_result(*cache_key)
+            if cached:
+                return send_cached_result(cached, request)
+
         if is_range_request:
-            download_request_headers = {"Range": request.headers.get("range")}
-            download_response_headers = download_request_headers
+            # let the storage answer range requests itself when it can
+            download_request_headers["Range"] = request.headers.get("Range")
+            if request.headers.get("If-Range"):
+                download_request_headers["If-Range"] = request.headers.get("If-Range")
+        # bytes are passed through as they come, so only ask for an encoding the client accepts
+        download_request_headers["Accept-Encoding"] = request.headers.get(
+            "Accept-Encoding", "identity"
+        )
         # IPFS utils
         ipfs_x_api_key = getenv("X-API-KEY", None)
         if ipfs_x_api_key:
@@ -176,45 +343,85 @@ def build_download_response(request, requests_session, url, content_type=None):
             download_request_headers["CLIENT-ID"] = ipfs_client_id
 
         response = requests_session.get(
-            url, headers=download_request_headers, stream=True, timeout=3
+            url,
+            headers=download_request_headers,
+            stream=True,
+            timeout=get_download_timeout(),
         )
 
-        if not is_range_request:
-            filename = url.split("/")[-1]
-
-            content_disposition_header = response.headers.get("content-disposition")
-            if content_disposition_header:
-                _, content_disposition_params = parse_header(content_disposition_header)
-                content_filename = content_disposition_params.get("filename")
-                if content_filename:
-                    filename = content_filename
-
-            content_type_header = response.headers.get("content-type")
-            if content_type_header:
-                content_type = content_type_header
-
-            file_ext = os.path.splitext(filename)[1]
-            if file_ext and not content_type:
-                content_type = mimetypes.guess_type(filename)[0]
-            elif not file_ext and content_type:
-                # add an extension to filename based on the content_type
-                extension = mimetypes.guess_extension(content_type)
-                if extension:
-                    filename = filename + extension
-
-            download_response_headers = {
-                "Content-Disposition": f"attachment;filename={filename}",
-                "Access-Control-Expose-Headers": "Content-Disposition",
-            }
+        content_type_header = response.headers.get("content-type")
+        if content_type_header:
+            content_type = content_type_header
+        filename, content_type = get_download_filename(
+            url, content_type, response.headers.get("content-disposition")
+        )
+        download_response_headers = get_attachment_headers(filename)
+        for header in [
+            "Content-Encoding",
+            "Content-Length",
+            "Content-Range",
+            "Accept-Ranges",
+            "ETag",
+            "Last-Modified",
+        ]:
+            if header in response.headers:
+                download_response_headers[header] = response.headers[header]
+
+        chunk_size = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
 
         def _generate(_response):
-            for chunk in _response.iter_content(chunk_size=4096):
-                if chunk:
-                    yield chunk
+            try:
+                for chunk in _response.raw.stream(chunk_size, decode_content=False):
+                    if chunk:
+                        DOWNLOAD_BYTES.labels("storage").inc(len(chunk))
+                        yield chunk
+            finally:
+                # gives the connection back to the session pool
+                _response.close()
+
+        body = _generate(response)
+        status = response.status_code
+        content_length = response.headers.get("Content-Length")
+        identity = response.headers.get("Content-Encoding", "identity") == "identity"
+        if status == 200 and identity and content_length:
+            # the full body goes through here, so ranges can be sliced from it
+            content_length = int(content_length)
+            download_response_headers.setdefault("Accept-Ranges", "bytes")
+            if (
+                is_range_request
+                and request.range.units == "bytes"
+                and len(request.range.ranges) == 1
+                and if_range_matches(
+                    request,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+            ):
+                # storage ignored the Range header, multiple ranges get the full body
+                ranges = get_byte_ranges(request.range, content_length)
+                if not ranges:
+                    response.close()
+                    return range_not_satisfiable_response(content_length)
+                start, stop = ranges[0]
+                body = slice_chunks(body, start, stop)
+                status = 206
+                download_response_headers["Content-Length"] = str(stop - start)
+                download_response_headers["Content-Range"] = (
+                    f"bytes {start}-{stop - 1}/{content_length}"
+                )
+
+        if cache_key and status == 200 and identity:
+            meta = {
+                "filename": filename,
+                "content_type": content_type,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            body = cache_while_streaming(body, *cache_key, meta, content_length or None)
 
         return Response(
-            _generate(response),
-            response.status_code,
+            body,
+            status,
             headers=download_response_headers,
             content_type=content_type,
         )
@@ -223,38 +430,101 @@ def build_download_response(request, requests_session, url, content_type=None):
         raise
 
 
-def sanitize_response_for_provider(d):
+def encode_for_provider(obj):
     """
-    Sanitize objects to send them to provider by recursively convert Decimal and float values to string
-    in: dict | list | tuple | set | str | int | float | None
-    out: dict | list | tuple | set | str | int | float | None
+    JSON text of jobs sent to providers, Decimal values become strings.
+    Encoded in one pass, without copying the jobs first.
     """
-    if isinstance(d, Decimal):
-        return str(d)
-    elif isinstance(d, float):
-        return str(d)
-    elif isinstance(d, dict):
-        return {
-            sanitize_response_for_provider(k): sanitize_response_for_provider(v)
-            for k, v in d.items()
-        }
-    elif isinstance(d, list):
-        return [sanitize_response_for_provider(element) for element in d]
-    else:
-        return d
+    return json.dumps(obj)
 
 
-def check_admin(admin):
-    allowed_admins = json.loads(os.environ["ALLOWED_ADMINS"])
-    logger.info(f"allowed admins: {allowed_admins}")
-    logger.info(f'{os.environ["ALLOWED_ADMINS"]}')
+def get_pagination_params(data):
+    """
+    Parses the optional `limit` and `cursor` keyset pagination parameters.
+    :return: (limit, after, error message)
+    """
+    limit = data.get("limit", None)
+    cursor = data.get("cursor", None)
+    after = None
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            return None, None, "`limit` must be a positive integer"
+        if limit < 1:
+            return None, None, "`limit` must be a positive integer"
+    if cursor:
+        try:
+            date_created, job_id = str(cursor).split(",", 1)
+            date_created = Decimal(date_created)
+            if not date_created.is_finite():
+                raise ValueError(cursor)
+            after = (str(date_created), job_id)
+        except (ValueError, ArithmeticError):
+            return None, None, "Invalid `cursor`"
+    return limit, after, None
+
+
+def get_page_cursor(job):
+    # opaque for clients, the (dateCreated, jobId) keyset of the given job
+    return f"{job['dateCreated']},{job['jobId']}"
+
+
+def stream_json_list(items, chunk_size=65536):
+    """
+    Encodes an iterable of jobs as a JSON array, yielding chunks of about chunk_size
+    characters so large responses start streaming before all rows are read.
+    """
+    buffer = ["["]
+    buffered = 1
+    separator = ""
+    for item in items:
+        encoded = separator + encode_for_provider(item)
+        separator = ","
+        buffer.append(encoded)
+        buffered += len(encoded)
+        if buffered >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+    buffer.append("]")
+    yield "".join(buffer)
+
+
+def get_weak_etag(fingerprint, *variant):
+    """
+    :param fingerprint: tuple which changes whenever the rows behind a response do
+    :param variant: request arguments shaping the response
+    :return: weak ETag value, None if the fingerprint is unknown
+    """
+    if fingerprint is None:
+        return None
+    key = json.dumps([fingerprint, variant], default=str)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
 
+def conditional_response(etag, build_response):
+    """
+    304 response when If-None-Match holds the etag, otherwise the response of
+    build_response() tagged with it.
+    """
+    if etag is None:
+        return build_response()
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": f'W/"{etag}"'})
+    response = build_response()
+    if response.status_code == 200:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def check_admin(admin):
     if not admin:
         msg = f"Admin header is empty."
         logger.error(f"msg: {msg}")
         return msg, 400
 
-    if admin.lower() not in [x.lower() for x in allowed_admins]:
+    if admin not in allowed_admins:
         msg = f"Access admin route failed due to invalid admin address."
         logger.error(msg)
         return msg, 401
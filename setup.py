@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 """The setup script."""
+
 #  Copyright 2018 Ocean Protocol Foundation
 #  SPDX-License-Identifier: Apache-2.0
 
@@ -29,7 +30,6 @@ install_requirements = [
     "gunicorn==21.2.0",
     "PyYAML>=5.4.1",
     "pytz==2018.5",
-    "simplejson>=3.13.2",
     "psycopg2>=2.8.4",
     "cryptography==37.0.4",
 ]
@@ -55,14 +55,21 @@ dev_requirements = [
 ]
 
 
-test_requirements = [
-    "codacy-coverage",
-    "coverage",
-    "mccabe",
-    "pylint",
-    "pytest",
-    "pytest-watch",
-]
+async_requirements = ["gevent>=21.12.0"]
+metrics_requirements = ["prometheus_client>=0.16.0"]
+
+test_requirements = (
+    async_requirements
+    + metrics_requirements
+    + [
+        "codacy-coverage",
+        "coverage",
+        "mccabe",
+        "pylint",
+        "pytest",
+        "pytest-watch",
+    ]
+)
 
 setup(
     author="leucothia",
@@ -79,6 +86,10 @@ setup(
     extras_require={
         "test": test_requirements,
         "dev": dev_requirements + test_requirements,
+        "coincurve": ["coincurve>=7.0.0,<13.0.0"],
+        "async": async_requirements,
+        "metrics": metrics_requirements,
+        "orjson": ["orjson>=3.6.0"],
     },
     include_package_data=True,
     install_requires=install_requirements,
@@ -18,26 +18,29 @@ def client():
 
 @pytest.fixture()
 def setup_mocks(monkeypatch):
-    from .kube_mock import KubeAPIMock
     from .sql_mock import SQLMock
 
     def mock_uuid():
         return FAKE_UUID
 
     monkeypatch.setattr(operator_service.routes, "generate_new_id", mock_uuid)
-    monkeypatch.setattr(operator_service.routes, "KubeAPI", KubeAPIMock)
     monkeypatch.setattr(
         operator_service.routes, "create_sql_job", SQLMock.mock_create_sql_job
     )
     monkeypatch.setattr(
-        operator_service.routes, "get_sql_jobs", SQLMock.mock_get_sql_jobs
+        operator_service.routes,
+        "is_agreement_id_in_use",
+        SQLMock.mock_is_agreement_id_in_use,
     )
     monkeypatch.setattr(
-        operator_service.routes, "stop_sql_job", SQLMock.mock_stop_sql_job
+        operator_service.routes, "stop_sql_jobs", SQLMock.mock_stop_sql_jobs
     )
     monkeypatch.setattr(
-        operator_service.routes, "remove_sql_job", SQLMock.mock_remove_sql_job
+        operator_service.routes, "remove_sql_jobs", SQLMock.mock_remove_sql_jobs
     )
     monkeypatch.setattr(
         operator_service.routes, "get_sql_status", SQLMock.mock_get_sql_status
     )
+    monkeypatch.setattr(
+        operator_service.routes, "iter_sql_status", SQLMock.mock_iter_sql_status
+    )
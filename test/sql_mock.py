@@ -32,21 +32,32 @@ class SQLMock:
         agreement_id, job_id, owner, body, environment, provider_address
     ):
         SQLMock.assert_expected_params(agreement_id, job_id, owner)
+        return MOCK_JOB_STATUS
 
     @staticmethod
-    def mock_get_sql_jobs(agreement_id, job_id, owner):
-        SQLMock.assert_expected_params(agreement_id, job_id, owner)
-        return MOCK_JOBS_LIST
+    def mock_is_agreement_id_in_use(agreement_id):
+        return False
 
     @staticmethod
-    def mock_stop_sql_job(job):
-        SQLMock.stopped_jobs.append(job)
+    def mock_stop_sql_jobs(agreement_id, job_id, owner):
+        SQLMock.assert_expected_params(agreement_id, job_id, owner)
+        SQLMock.stopped_jobs.extend(MOCK_JOBS_LIST)
+        return MOCK_JOBS_LIST
 
     @staticmethod
-    def mock_remove_sql_job(job):
-        SQLMock.removed_jobs.append(job)
+    def mock_remove_sql_jobs(agreement_id, job_id, owner):
+        SQLMock.assert_expected_params(agreement_id, job_id, owner)
+        SQLMock.removed_jobs.extend(MOCK_JOBS_LIST)
+        return MOCK_JOBS_LIST
 
     @staticmethod
     def mock_get_sql_status(agreement_id, job_id, owner, chain_id):
         SQLMock.assert_expected_params(agreement_id, job_id, owner)
         return MOCK_JOB_STATUS
+
+    @staticmethod
+    def mock_iter_sql_status(
+        agreement_id, job_id, owner, chain_id, limit=None, after=None
+    ):
+        SQLMock.assert_expected_params(agreement_id, job_id, owner)
+        yield MOCK_JOB_STATUS
@@ -1,4 +1,5 @@
 from operator_service.constants import BaseURLs
+from operator_service.migrations import MIGRATIONS, run_migrations
 
 API_URL = f"{BaseURLs.BASE_OPERATOR_URL}"
 
@@ -32,3 +33,77 @@ def test_admin(client, monkeypatch):
         "Access admin route failed due to invalid admin address."
         in pgsql_init_response.text
     )
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, query, params=None):
+        if self.connection.fail_on and self.connection.fail_on in query:
+            raise Exception("boom")
+        self.connection.executed.append((query, self.connection.autocommit))
+        if query.startswith("SELECT version FROM schema_migrations"):
+            self.rows = [(version,) for version in self.connection.applied]
+        elif query.startswith("INSERT INTO schema_migrations"):
+            self.connection.pending.append(params[0])
+            if self.connection.autocommit:
+                self.connection.commit()
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, applied=(), fail_on=None):
+        self.applied = list(applied)
+        self.pending = []
+        self.executed = []
+        self.fail_on = fail_on
+        self.autocommit = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.applied.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+def test_run_migrations():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+    connection = FakeConnection()
+    assert run_migrations(connection) == ""
+    assert connection.applied == versions
+    concurrent = [
+        autocommit
+        for query, autocommit in connection.executed
+        if "CONCURRENTLY" in query
+    ]
+    assert concurrent and all(concurrent)
+
+    # applied migrations are skipped
+    connection = FakeConnection(applied=versions)
+    assert run_migrations(connection) == ""
+    assert not [q for q, _ in connection.executed if "ALTER TABLE" in q]
+
+    # the first failure stops the run, its version is not recorded
+    connection = FakeConnection(fail_on="ADD COLUMN IF NOT EXISTS did")
+    output = run_migrations(connection)
+    assert "Error PostgreSQL: migration 2: boom" in output
+    assert connection.applied == [1]
+    assert "pg_advisory_unlock" in connection.executed[-1][0]
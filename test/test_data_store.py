@@ -0,0 +1,329 @@
+from decimal import Decimal
+import threading
+import time
+
+import psycopg2
+import pytest
+from prometheus_client import REGISTRY
+
+import operator_service.data_store as data_store
+from operator_service.exceptions import DatabaseUnavailableError
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.committed = False
+        self.cursors = []
+        self.info = type(
+            "Info",
+            (),
+            {"transaction_status": psycopg2.extensions.TRANSACTION_STATUS_IDLE},
+        )()
+
+    def cursor(self):
+        self.cursors.append(FakeCursor(self))
+        return self.cursors[-1]
+
+    def commit(self):
+        self.committed = True
+
+
+class FakeCursor:
+    rows = []
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 1
+        self.fetch_calls = 0
+        self.pending = []
+
+    def execute(self, query, record):
+        if self.connection.closed:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.pending = list(FakeCursor.rows)
+
+    def fetchall(self):
+        self.fetch_calls += 1
+        rows, self.pending = self.pending, []
+        return rows
+
+    def fetchmany(self):
+        self.fetch_calls += 1
+        rows = self.pending[: self.arraysize]
+        self.pending = self.pending[self.arraysize :]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    created = 0
+
+    def __init__(self, min_conn, max_conn, **kwargs):
+        FakePool.created += 1
+        self.free = []
+        self.discarded = []
+
+    def getconn(self):
+        return self.free.pop() if self.free else FakeConnection()
+
+    def putconn(self, connection, close=False):
+        if close:
+            self.discarded.append(connection)
+        else:
+            self.free.append(connection)
+
+
+def test_pool_reuses_connections(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    monkeypatch.setattr(FakePool, "created", 0)
+
+    data_store._execute_query("UPDATE jobs SET stopreq=1", (), "test")
+    connection = data_store.get_pg_pool().free[0]
+    assert connection.committed
+
+    data_store._execute_query("SELECT 1", (), "test", get_rows=True)
+    assert data_store.get_pg_pool().free == [connection]
+    assert FakePool.created == 1
+
+    # a forked worker must get its own pool
+    monkeypatch.setattr(data_store, "_pg_pool_pid", -1)
+    assert data_store.get_pg_pool().free == []
+    assert FakePool.created == 2
+
+
+def test_pool_discards_broken_connections(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+
+    pool = data_store.get_pg_pool()
+    broken = FakeConnection()
+    broken.closed = 1
+    pool.free.append(broken)
+
+    connection = data_store.get_pooled_connection()
+    assert connection is not broken
+    assert pool.discarded == [broken]
+    data_store.release_pooled_connection(connection)
+
+
+def test_pool_is_created_once(monkeypatch):
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    monkeypatch.setattr(FakePool, "created", 0)
+
+    class SlowPool(FakePool):
+        def __init__(self, *args, **kwargs):
+            # ThreadedConnectionPool connects minconn connections right away
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", SlowPool)
+    pools = []
+    threads = [
+        threading.Thread(target=lambda: pools.append(data_store.get_pg_pool()))
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakePool.created == 1
+    assert pools[0] is pools[1]
+
+
+def test_pool_release_to_origin(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    monkeypatch.setenv("POSTGRES_POOL_MAX", "1")
+
+    first_pool = data_store.get_pg_pool()
+    connection = data_store.get_pooled_connection()
+    # the connection still belongs to the first pool once it is replaced
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    second_pool = data_store.get_pg_pool()
+    other = data_store.get_pooled_connection()
+
+    data_store.release_pooled_connection(connection)
+    assert first_pool.free == [connection]
+    assert second_pool.free == []
+    data_store.release_pooled_connection(other)
+    assert second_pool.free == [other]
+    # released once, the connection is not returned again
+    data_store.release_pooled_connection(connection)
+    assert first_pool.free == [connection]
+
+
+def test_pool_metrics(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+
+    def used():
+        return REGISTRY.get_sample_value("operator_pg_pool_connections_used")
+
+    before = used()
+    connection = data_store.get_pooled_connection()
+    other = data_store.get_pooled_connection()
+    assert used() == before + 2
+    data_store.release_pooled_connection(connection)
+    data_store.release_pooled_connection(other, broken=True)
+    assert used() == before
+    # a connection released twice is only counted once
+    data_store.release_pooled_connection(connection)
+    assert used() == before
+
+
+def test_pool_exhaustion_raises(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    monkeypatch.setenv("POSTGRES_POOL_MAX", "1")
+    monkeypatch.setenv("POSTGRES_POOL_TIMEOUT", "0.01")
+
+    connection = data_store.get_pooled_connection()
+    # a full pool must not read as "no rows" or "not in use"
+    with pytest.raises(DatabaseUnavailableError):
+        data_store.is_agreement_id_in_use("agreement")
+    with pytest.raises(DatabaseUnavailableError):
+        list(data_store.iter_sql_status(None, None, "owner", None))
+
+    data_store.release_pooled_connection(connection)
+    assert data_store.is_agreement_id_in_use("agreement") is False
+
+
+def test_iter_query_fetches_in_batches(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    monkeypatch.setattr(FakeCursor, "rows", [(i,) for i in range(5)])
+
+    rows = data_store._iter_query(
+        "SELECT 1", (), "test", data_store.FETCH_MANY, arraysize=2
+    )
+    assert list(rows) == [(0,), (1,), (2,), (3,), (4,)]
+    # 3 batches plus the final empty one, then the connection goes back to the pool
+    connection = data_store.get_pg_pool().free[0]
+    assert connection.cursors[0].fetch_calls == 4
+
+
+def test_iter_query_raises_midway(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    monkeypatch.setattr(data_store, "_pg_pool", None)
+    monkeypatch.setattr(FakeCursor, "rows", [(i,) for i in range(5)])
+    fetchmany = FakeCursor.fetchmany
+
+    def failing_fetchmany(cursor):
+        if cursor.fetch_calls:
+            raise psycopg2.OperationalError("server closed the connection")
+        return fetchmany(cursor)
+
+    monkeypatch.setattr(FakeCursor, "fetchmany", failing_fetchmany)
+    rows = data_store._iter_query(
+        "SELECT 1", (), "test", data_store.FETCH_MANY, arraysize=2
+    )
+    assert next(rows) == (0,)
+    assert next(rows) == (1,)
+    # the consumer sees the error, not the end of the rows
+    with pytest.raises(psycopg2.OperationalError):
+        next(rows)
+    assert data_store.get_pg_pool().discarded
+
+
+def test_update_sql_jobs(monkeypatch):
+    queries = []
+
+    def execute_query(query, record, msg, get_rows=False, commit=None):
+        queries.append((" ".join(query.split()), dict(record), msg, commit))
+        return [("job1",), ("job2",)]
+
+    monkeypatch.setattr(data_store, "_execute_query", execute_query)
+    assert data_store.stop_sql_jobs("agreement", None, "owner") == ["job1", "job2"]
+    assert data_store.remove_sql_jobs(None, "job1", "owner") == ["job1", "job2"]
+    assert data_store.stop_sql_jobs(None, None, "owner") == ["job1", "job2"]
+    assert queries == [
+        (
+            "UPDATE jobs SET stopreq=1 WHERE 1=1 AND agreementId=%(agreementId)s"
+            " AND owner=%(owner)s RETURNING workflowId",
+            {"agreementId": "agreement", "owner": "owner"},
+            "stop_sql_jobs",
+            True,
+        ),
+        (
+            "UPDATE jobs SET removed=1 WHERE 1=1 AND workflowId=%(jobId)s"
+            " AND owner=%(owner)s RETURNING workflowId",
+            {"jobId": "job1", "owner": "owner"},
+            "remove_sql_jobs",
+            True,
+        ),
+        (
+            "UPDATE jobs SET stopreq=1 WHERE 1=1 AND owner=%(owner)s"
+            " RETURNING workflowId",
+            {"owner": "owner"},
+            "stop_sql_jobs",
+            True,
+        ),
+    ]
+
+    monkeypatch.setattr(data_store, "_execute_query", lambda *args, **kwargs: None)
+    assert data_store.remove_sql_jobs(None, "job1", "owner") is None
+
+
+def test_environments_cache(monkeypatch):
+    queries = []
+
+    def execute_query(query, record, msg, get_rows=False, commit=None):
+        queries.append(msg)
+        if msg == "get_environments_fingerprint":
+            return [(1, fingerprint)]
+        # chains are filtered by Postgresql
+        if record["allowedChainId"] != '{"allowedChainId":[8996]}':
+            return []
+        return [("env1", '{"allowedChainId": [8996]}', 1700000000.0)]
+
+    fingerprint = 1
+    monkeypatch.setattr(data_store, "_execute_query", execute_query)
+    monkeypatch.setattr(
+        data_store,
+        "_environments_cache",
+        {"checked": None, "fingerprint": None, "by_chain": dict()},
+    )
+    monkeypatch.setenv("ENVIRONMENTS_CACHE_TTL", "0.001")
+
+    envs = data_store.get_cached_environments(8996)
+    assert envs[0]["id"] == "env1"
+    assert data_store.get_cached_environments(1) == []
+    time.sleep(0.01)
+    assert data_store.get_cached_environments(8996) == envs
+    assert queries.count("get_sql_environments") == 2
+
+    # a new announce drops the cached answers
+    fingerprint = 2
+    time.sleep(0.01)
+    data_store.get_cached_environments(8996)
+    assert queries.count("get_sql_environments") == 3
+
+
+def test_status_rows_are_sent_as_text(monkeypatch):
+    # numeric epochs (Postgresql >= 14), double precision ones before
+    row = (
+        "agreement",
+        "job",
+        "owner",
+        70,
+        "Job finished",
+        Decimal("1700000000.123456"),
+        1700000060.5,
+        '[{"filesize": 1e3, "filename": "out", "url": "http://x"}]',
+        0,
+        0,
+        "did:op:algo",
+        None,
+    )
+    monkeypatch.setattr(data_store, "_iter_query", lambda *args: iter([row]))
+    [job] = data_store.get_sql_status(None, "job", None, None)
+    assert job["dateCreated"] == "1700000000.123456"
+    assert job["dateFinished"] == "1700000060.5"
+    assert job["results"] == [{"filesize": "1000.0", "filename": "out"}]
+    # providers get the outputs with their stored key order
+    assert list(job["results"][0]) == ["filesize", "filename"]
+    assert job["inputDID"] == []
@@ -1,3 +1,4 @@
+import copy
 import json
 import random
 import string
@@ -7,7 +8,12 @@ from unittest.mock import patch
 from web3 import Web3
 
 from operator_service.constants import BaseURLs, Metadata
-from operator_service.data_store import get_pg_connection_and_cursor
+from operator_service.data_store import (
+    get_pg_connection_and_cursor,
+    is_agreement_id_in_use,
+)
+from operator_service.migrations import run_migrations
+from operator_service.utils import create_compute_job
 
 from . import operator_payloads as payloads
 from .utils import decorate_nonce
@@ -117,3 +123,74 @@ def test_start_compute_job(client, monkeypatch):
     )
     delete_compute_response = client.delete(f"{API_URL}/compute", json=req_body)
     assert delete_compute_response.status_code == 200
+
+
+def test_migration_backfills_job_columns(client, monkeypatch):
+    monkeypatch.setenv(
+        "ALLOWED_ADMINS", '["0x6d39a833d1a6789aeca50db85cb830bc08319f45"]'
+    )
+    headers = {"Admin": "0x6d39a833d1a6789aeca50db85cb830bc08319f45"}
+    client.post(f"{API_URL}/pgsqlinit", headers=headers)
+
+    # a job stored before the extracted columns, as POST /compute built it
+    workflow = copy.deepcopy(payloads.VALID_COMPUTE_BODY["workflow"])
+    workflow["chainId"] = "8996"
+    body = create_compute_job(workflow, "legacy-job", "ocean-compute")
+    connection, cursor = get_pg_connection_and_cursor()
+    cursor.execute("DELETE FROM jobs WHERE workflowId = 'legacy-job'")
+    cursor.execute(
+        """
+        INSERT INTO jobs (agreementId, workflowId, owner, status, workflow)
+        VALUES ('legacy-agreement', 'legacy-job', 'legacy-owner', 70, %s)
+        """,
+        (json.dumps(body),),
+    )
+    cursor.execute("DELETE FROM schema_migrations WHERE version = 3")
+    connection.commit()
+
+    assert run_migrations(connection) == ""
+    cursor.execute(
+        "SELECT chainId, algoDID, inputDIDs FROM jobs WHERE workflowId = 'legacy-job'"
+    )
+    stage = workflow["stages"][0]
+    assert cursor.fetchone() == (
+        "8996",
+        stage["algorithm"]["id"],
+        [item["id"] for item in stage["input"]],
+    )
+    cursor.execute("DELETE FROM jobs WHERE workflowId = 'legacy-job'")
+    connection.commit()
+    connection.close()
+
+
+def test_start_compute_job_agreement_in_use(client, monkeypatch):
+    monkeypatch.setenv(
+        "ALLOWED_ADMINS", '["0x6d39a833d1a6789aeca50db85cb830bc08319f45"]'
+    )
+    headers = {"Admin": "0x6d39a833d1a6789aeca50db85cb830bc08319f45"}
+    client.post(f"{API_URL}/pgsqlinit", headers=headers)
+
+    connection, cursor = get_pg_connection_and_cursor()
+    cursor.execute("DELETE FROM jobs WHERE agreementId = 'busy-agreement'")
+    cursor.execute("""
+        INSERT INTO jobs (agreementId, workflowId, owner, status)
+        VALUES ('busy-agreement', 'busy-job', 'busy-owner', 10)
+        """)
+    connection.commit()
+
+    req_body = copy.deepcopy(payloads.VALID_COMPUTE_BODY)
+    req_body["agreementId"] = "busy-agreement"
+    response = client.post(COMPUTE_URL, json=decorate_nonce(req_body))
+    assert response.status_code == 400
+    assert response.json["error"] == "`agreementId` already in use for other job."
+
+    # finished jobs release their agreementId
+    cursor.execute(
+        "UPDATE jobs SET dateFinished = NOW() WHERE agreementId = 'busy-agreement'"
+    )
+    connection.commit()
+    assert is_agreement_id_in_use("busy-agreement") is False
+
+    cursor.execute("DELETE FROM jobs WHERE agreementId = 'busy-agreement'")
+    connection.commit()
+    connection.close()
@@ -1,6 +1,11 @@
+from decimal import Decimal
 from unittest.mock import patch
 
+import psycopg2
+
+from operator_service import job_events
 from operator_service.constants import BaseURLs, Metadata
+from operator_service.exceptions import DatabaseUnavailableError
 
 from . import operator_payloads as payloads
 from .conftest import FAKE_UUID
@@ -36,7 +41,7 @@ def test_start_compute_job(client, monkeypatch, setup_mocks):
             COMPUTE_URL, json=decorate_nonce(payloads.VALID_COMPUTE_BODY)
         )
     assert response.status_code == 200
-    assert response.json == MOCK_JOB_STATUS
+    assert response.json == [MOCK_JOB_STATUS]
 
     response = client.post(COMPUTE_URL, json={})
     assert response.status_code == 400
@@ -73,7 +78,7 @@ def test_start_compute_job(client, monkeypatch, setup_mocks):
             COMPUTE_URL, json=decorate_nonce(payloads.VALID_COMPUTE_BODY)
         )
     assert response.status_code == 200
-    assert response.json == MOCK_JOB_STATUS
+    assert response.json == [MOCK_JOB_STATUS]
 
     monkeypatch.setattr(
         SQLMock,
@@ -86,7 +91,7 @@ def test_start_compute_job(client, monkeypatch, setup_mocks):
             json=decorate_nonce(payloads.VALID_COMPUTE_BODY_WITH_NO_MAXTIME),
         )
     assert response.status_code == 200
-    assert response.json == MOCK_JOB_STATUS
+    assert response.json == [MOCK_JOB_STATUS]
 
 
 def test_stop_compute_job(client, monkeypatch, setup_mocks):
@@ -132,10 +137,22 @@ def test_stop_compute_job(client, monkeypatch, setup_mocks):
     assert response.status_code == 400
 
 
-def test_delete_compute_job(client, monkeypatch):
+def test_delete_compute_job(client, monkeypatch, setup_mocks):
+    with monkeypatch.context() as m:
+        m.setattr(SQLMock, "expected_owner", "fake-owner")
+        m.setattr(SQLMock, "expected_job_id", "fake-job-id")
+        response = client.delete(
+            COMPUTE_URL,
+            json=decorate_nonce(
+                {"jobId": SQLMock.expected_job_id, "owner": SQLMock.expected_owner}
+            ),
+        )
+        assert response.status_code == 200
+        assert response.json == MOCK_JOB_STATUS
+        SQLMock.assert_all_jobs_removed_and_reset()
+
     response = client.delete(COMPUTE_URL, json={})
-    assert response.status_code == 200
-    assert response.json == ""
+    assert response.status_code == 400
 
 
 def test_get_compute_job_status(client, monkeypatch, setup_mocks):
@@ -151,7 +168,7 @@ def test_get_compute_job_status(client, monkeypatch, setup_mocks):
                 json=decorate_nonce({"agreementId": SQLMock.expected_agreement_id}),
             )
     assert response.status_code == 200
-    assert response.json == MOCK_JOB_STATUS
+    assert response.json == [MOCK_JOB_STATUS]
 
     with monkeypatch.context() as m:
         m.setattr(SQLMock, "expected_job_id", "fake-job-id")
@@ -163,7 +180,7 @@ def test_get_compute_job_status(client, monkeypatch, setup_mocks):
             )
 
     assert response.status_code == 200
-    assert response.json == MOCK_JOB_STATUS
+    assert response.json == [MOCK_JOB_STATUS]
 
     with monkeypatch.context() as m:
         m.setattr(SQLMock, "expected_owner", "fake-owner")
@@ -175,7 +192,171 @@ def test_get_compute_job_status(client, monkeypatch, setup_mocks):
             )
 
     assert response.status_code == 200
-    assert response.json == MOCK_JOB_STATUS
+    assert response.json == [MOCK_JOB_STATUS]
 
     response = client.get(COMPUTE_URL, json={})
     assert response.status_code == 400
+
+
+def test_get_compute_job_status_pagination(client, monkeypatch):
+    jobs = [
+        {"jobId": f"job{i}", "dateCreated": Decimal(f"1700000000.00000{i}")}
+        for i in range(3)
+    ]
+
+    def mock_iter_sql_status(
+        agreement_id, job_id, owner, chain_id, limit=None, after=None
+    ):
+        assert owner == "fake-owner"
+        remaining = [job for job in jobs if after is None or job["jobId"] > after[1]]
+        return iter(remaining[:limit])
+
+    monkeypatch.setattr("operator_service.routes.iter_sql_status", mock_iter_sql_status)
+    response = client.get(
+        COMPUTE_URL, json=decorate_nonce({"owner": "fake-owner", "limit": 2})
+    )
+    assert response.status_code == 200
+    assert [job["jobId"] for job in response.json] == ["job0", "job1"]
+    assert response.headers["X-Next-Cursor"] == "1700000000.000001,job1"
+
+    response = client.get(
+        COMPUTE_URL,
+        json=decorate_nonce(
+            {
+                "owner": "fake-owner",
+                "limit": 2,
+                "cursor": response.headers["X-Next-Cursor"],
+            }
+        ),
+    )
+    assert response.status_code == 200
+    assert [job["jobId"] for job in response.json] == ["job2"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get(
+        COMPUTE_URL, json=decorate_nonce({"owner": "fake-owner", "limit": 0})
+    )
+    assert response.status_code == 400
+
+
+def test_watch_compute_job_status(client, monkeypatch, setup_mocks):
+    # sync workers do not serve streams
+    response = client.get(
+        f"{COMPUTE_URL}/watch", json=decorate_nonce({"owner": "fake-owner"})
+    )
+    assert response.status_code == 501
+
+    monkeypatch.setattr("operator_service.routes.is_gevent_patched", lambda: True)
+    monkeypatch.setattr("operator_service.job_events._start_listener", lambda: None)
+    monkeypatch.setenv("WATCH_MAX_DURATION", "0")
+    monkeypatch.setattr(SQLMock, "expected_owner", "fake-owner")
+    response = client.get(
+        f"{COMPUTE_URL}/watch", json=decorate_nonce({"owner": "fake-owner"})
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.get_data(as_text=True).startswith("event: status\ndata: ")
+    response.close()
+
+    assert not job_events._subscribers
+
+    response = client.get(f"{COMPUTE_URL}/watch", json={})
+    assert response.status_code == 400
+
+
+def test_get_compute_job_status_etag(client, monkeypatch, setup_mocks):
+    fingerprint = [(1, "2023-01-01 00:00:00", Decimal("1672531200"))]
+    monkeypatch.setattr(
+        "operator_service.routes.get_sql_status_fingerprint",
+        lambda agreement_id, job_id, owner, chain_id: fingerprint[0],
+    )
+    monkeypatch.setattr(SQLMock, "expected_owner", "fake-owner")
+    response = client.get(COMPUTE_URL, json=decorate_nonce({"owner": "fake-owner"}))
+    assert response.status_code == 200
+    assert response.json == [MOCK_JOB_STATUS]
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+
+    response = client.get(
+        COMPUTE_URL,
+        json=decorate_nonce({"owner": "fake-owner"}),
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 304
+    assert response.data == b""
+
+    # the signature is checked before answering 304
+    response = client.get(
+        COMPUTE_URL,
+        json={"owner": "fake-owner", "nonce": "1", "providerSignature": "0x00"},
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 400
+    assert response.json == {"error": "Failed to recover address"}
+
+    # another page or a change of the jobs gives another etag
+    response = client.get(
+        COMPUTE_URL,
+        json=decorate_nonce({"owner": "fake-owner", "limit": 10}),
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.json == [MOCK_JOB_STATUS]
+    assert response.headers["ETag"] != etag
+    fingerprint[0] = (2, "2023-01-01 00:00:01", Decimal("3345062401"))
+    response = client.get(
+        COMPUTE_URL,
+        json=decorate_nonce({"owner": "fake-owner"}),
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_get_environments_etag(client, monkeypatch):
+    monkeypatch.setattr(
+        "operator_service.routes.get_cached_environments_fingerprint",
+        lambda: (1, "2023-01-01 00:00:00", Decimal("1672531200")),
+    )
+    monkeypatch.setattr(
+        "operator_service.routes.get_cached_environments",
+        lambda chain_id: [{"id": "env1"}],
+    )
+    url = f"{BaseURLs.BASE_OPERATOR_URL}/environments"
+    response = client.get(url, query_string={"chainId": 1})
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        url, query_string={"chainId": 1}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    response = client.get(
+        url, query_string={"chainId": 2}, headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+
+def test_database_unavailable(client, monkeypatch):
+    def pool_timeout():
+        raise DatabaseUnavailableError("No free PG connection in the pool")
+
+    monkeypatch.setattr(
+        "operator_service.routes.get_sql_running_jobs_fingerprint", pool_timeout
+    )
+    response = client.get(f"{BaseURLs.BASE_OPERATOR_URL}/runningjobs")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+
+
+def test_get_running_jobs_query_error(client, monkeypatch):
+    def failing_jobs(limit, after):
+        raise psycopg2.OperationalError("server closed the connection")
+        yield
+
+    monkeypatch.setattr(
+        "operator_service.routes.get_sql_running_jobs_fingerprint", lambda: None
+    )
+    monkeypatch.setattr("operator_service.routes.iter_sql_running_jobs", failing_jobs)
+    response = client.get(f"{BaseURLs.BASE_OPERATOR_URL}/runningjobs")
+    assert response.status_code == 400
@@ -0,0 +1,528 @@
+import json
+import logging
+import logging.handlers
+import os
+from decimal import Decimal
+from http.client import HTTPMessage
+from types import SimpleNamespace
+
+import pytest
+from flask import request
+from requests import Request
+from requests.cookies import extract_cookies_to_jar
+
+from operator_service import green, json_codec, log, utils
+from operator_service.config import AllowList
+from operator_service.exceptions import InvalidSignatureError
+from operator_service.myapp import app
+from operator_service.utils import get_signer
+
+from . import operator_payloads as payloads
+from .utils import sign_message
+
+
+def test_get_signer_is_cached():
+    message = f"{payloads.VALID_WALLET.address}cached"
+    signature = sign_message(message, payloads.VALID_WALLET)
+    get_signer.cache_clear()
+
+    address = get_signer(signature, message)
+    assert address == payloads.VALID_WALLET.address.lower()
+    assert get_signer(signature, message) == address
+
+    cache_info = get_signer.cache_info()
+    assert cache_info.misses == 1
+    assert cache_info.hits == 1
+
+
+def test_allow_list(monkeypatch, tmp_path):
+    allow_list = AllowList("TEST_ALLOWED")
+    monkeypatch.setenv("TEST_ALLOWED", '["0xAbC"]')
+    assert "0xabc" in allow_list
+    assert "0xABC" in allow_list
+    assert "0xdef" not in allow_list
+    assert None not in allow_list
+
+    monkeypatch.setenv("TEST_ALLOWED", '["0xDef"]')
+    assert "0xdef" in allow_list
+
+    monkeypatch.setenv("TEST_ALLOWED", "not json")
+    assert allow_list.get() == frozenset()
+
+    allowed_file = tmp_path / "allowed.json"
+    allowed_file.write_text('["0x123"]')
+    monkeypatch.setenv("TEST_ALLOWED_FILE", str(allowed_file))
+    assert allow_list.get() == frozenset(["0x123"])
+
+    # same mtime, only picked up after an explicit reload
+    mtime = allowed_file.stat().st_mtime_ns
+    allowed_file.write_text('["0x456"]')
+    os.utime(allowed_file, ns=(mtime, mtime))
+    assert "0x123" in allow_list
+    allow_list.reload()
+    assert allow_list.get() == frozenset(["0x456"])
+
+
+def test_requests_session_is_shared(monkeypatch):
+    monkeypatch.setattr(utils, "_requests_session", None)
+    monkeypatch.setenv("DOWNLOAD_POOL_HOSTS", '{"https://storage.example.com": 100}')
+
+    session = utils.get_requests_session()
+    assert utils.get_requests_session() is session
+    adapter = session.get_adapter("https://storage.example.com/result")
+    assert adapter._pool_maxsize == 100
+    assert adapter.max_retries.total == 2
+
+    # a forked worker must not share sockets with its parent
+    monkeypatch.setattr(utils, "_requests_session_pid", -1)
+    assert utils.get_requests_session() is not session
+
+
+def test_requests_session_ignores_cookies(monkeypatch):
+    monkeypatch.setattr(utils, "_requests_session", None)
+    session = utils.get_requests_session()
+
+    message = HTTPMessage()
+    message["Set-Cookie"] = "session=consumer1; Path=/"
+    storage_response = SimpleNamespace(_original_response=SimpleNamespace(msg=message))
+    download = Request("GET", "https://storage.example.com/result").prepare()
+    extract_cookies_to_jar(session.cookies, download, storage_response)
+    assert len(session.cookies) == 0
+
+    next_download = session.prepare_request(
+        Request("GET", "https://storage.example.com/other")
+    )
+    assert "Cookie" not in next_download.headers
+
+
+class FakeRaw:
+    def __init__(self, body):
+        self.body = body
+        self.chunk_sizes = []
+
+    def stream(self, chunk_size, decode_content=True):
+        assert decode_content is False
+        self.chunk_sizes.append(chunk_size)
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i : i + chunk_size]
+
+
+class FakeDownloadResponse:
+    def __init__(self, body, headers):
+        self.raw = FakeRaw(body)
+        self.headers = headers
+        self.status_code = 200
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDownloadSession:
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, headers, stream, timeout):
+        self.requests.append((url, headers))
+        return self.response
+
+
+def test_build_download_response_passthrough(monkeypatch):
+    monkeypatch.setenv("DOWNLOAD_CHUNK_SIZE", "4")
+    upstream = FakeDownloadResponse(
+        b"compressed", {"Content-Encoding": "gzip", "Content-Length": "10"}
+    )
+    session = FakeDownloadSession(upstream)
+    with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+        response = utils.build_download_response(
+            request, session, "https://storage.example.com/out/result.txt"
+        )
+        assert b"".join(response.response) == b"compressed"
+
+    assert session.requests[0][1]["Accept-Encoding"] == "gzip"
+    assert upstream.raw.chunk_sizes == [4]
+    assert upstream.closed
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Length"] == "10"
+    assert response.headers["Content-Disposition"] == "attachment;filename=result.txt"
+
+
+def test_build_download_response_accel_redirect(monkeypatch):
+    monkeypatch.setenv("DOWNLOAD_ACCEL_HEADER", "X-Accel-Redirect")
+    monkeypatch.setenv(
+        "DOWNLOAD_ACCEL_MAP", '{"https://storage.example.com/": "/protected/"}'
+    )
+    session = FakeDownloadSession(None)
+    with app.test_request_context():
+        response = utils.build_download_response(
+            request, session, "https://storage.example.com/out/result.txt"
+        )
+
+    assert session.requests == []
+    assert response.headers["X-Accel-Redirect"] == "/protected/out/result.txt"
+    assert response.headers["Content-Disposition"] == "attachment;filename=result.txt"
+    assert response.content_type.startswith("text/plain")
+
+
+def test_build_download_response_result_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("RESULT_CACHE_DIR", str(tmp_path))
+    upstream = FakeDownloadResponse(b"0123456789", {"Content-Length": "10"})
+    session = FakeDownloadSession(upstream)
+    url = "https://storage.example.com/out/result.txt"
+
+    with app.test_request_context():
+        response = utils.build_download_response(
+            request, session, url, cache_key=("job1", 0)
+        )
+        assert b"".join(response.response) == b"0123456789"
+
+    # served from disk now, range requests included
+    with app.test_request_context(headers={"Range": "bytes=2-4"}):
+        response = utils.build_download_response(
+            request, session, url, cache_key=("job1", 0)
+        )
+        response.direct_passthrough = False
+        assert response.status_code == 206
+        assert response.get_data() == b"234"
+    assert len(session.requests) == 1
+    assert response.headers["Content-Disposition"] == "attachment;filename=result.txt"
+    with app.test_request_context():
+        response = utils.build_download_response(
+            request, session, url, cache_key=("job1", 0)
+        )
+        assert response.headers["Content-Disposition"] == (
+            "attachment;filename=result.txt"
+        )
+        response.close()
+
+    # least recently used results go first
+    monkeypatch.setenv("RESULT_CACHE_MAX_SIZE", "15")
+    for job_id in ["job2", "job3"]:
+        upstream = FakeDownloadResponse(b"0123456789", {"Content-Length": "10"})
+        with app.test_request_context():
+            response = utils.build_download_response(
+                request,
+                FakeDownloadSession(upstream),
+                url,
+                cache_key=(job_id, 0),
+            )
+            b"".join(response.response)
+    assert utils.get_cached_result("job1", 0) is None
+    assert utils.get_cached_result("job2", 0) is None
+    assert utils.get_cached_result("job3", 0) is not None
+
+
+def test_build_download_response_ranges(monkeypatch, tmp_path):
+    monkeypatch.setenv("DOWNLOAD_CHUNK_SIZE", "3")
+    url = "https://storage.example.com/out/result.txt"
+    validators = {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+
+    def download(headers, cache_key=None):
+        upstream = FakeDownloadResponse(
+            b"0123456789", dict(validators, **{"Content-Length": "10"})
+        )
+        session = FakeDownloadSession(upstream)
+        with app.test_request_context(headers=headers):
+            response = utils.build_download_response(
+                request, session, url, cache_key=cache_key
+            )
+            response.direct_passthrough = False
+            return response, session
+
+    # storage ignored the range, it is sliced from the full body
+    response, session = download({"Range": "bytes=2-5", "If-Range": '"v1"'})
+    assert session.requests[0][1]["Range"] == "bytes=2-5"
+    assert session.requests[0][1]["If-Range"] == '"v1"'
+    assert response.status_code == 206
+    assert response.get_data() == b"2345"
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+    assert response.headers["Content-Length"] == "4"
+    assert response.headers["ETag"] == '"v1"'
+
+    response, _ = download({"Range": "bytes=-3"})
+    assert response.get_data() == b"789"
+
+    # result changed since the first part was downloaded
+    response, _ = download({"Range": "bytes=2-5", "If-Range": '"v0"'})
+    assert response.status_code == 200
+    assert response.get_data() == b"0123456789"
+
+    response, _ = download({"Range": "bytes=20-30"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+
+    # multiple ranges from the result cache
+    monkeypatch.setenv("RESULT_CACHE_DIR", str(tmp_path))
+    download({}, cache_key=("job1", 0))[0].get_data()
+    response, session = download(
+        {"Range": "bytes=0-1,8-", "If-Range": '"v1"'}, cache_key=("job1", 0)
+    )
+    assert session.requests == []
+    assert response.status_code == 206
+    boundary = response.mimetype_params["boundary"]
+    assert (
+        response.get_data()
+        == (
+            f"\r\n--{boundary}\r\nContent-Type: text/plain\r\n"
+            f"Content-Range: bytes 0-1/10\r\n\r\n01"
+            f"\r\n--{boundary}\r\nContent-Type: text/plain\r\n"
+            f"Content-Range: bytes 8-9/10\r\n\r\n89"
+            f"\r\n--{boundary}--\r\n"
+        ).encode()
+    )
+
+    response, _ = download({"Range": "bytes=3-4"}, cache_key=("job1", 0))
+    assert response.status_code == 206
+    assert response.get_data() == b"34"
+    assert response.headers["ETag"] == '"v1"'
+
+
+def test_metrics(client):
+    client.get("/")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert (
+        b'operator_request_duration_seconds_count{endpoint="version"' in response.data
+    )
+
+
+@pytest.fixture
+def restore_logging():
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+    saved_handlers = [(logger, list(logger.handlers)) for logger in loggers]
+    saved_filters = [
+        (handler, list(handler.filters))
+        for _, handlers in saved_handlers
+        for handler in handlers
+    ]
+    listeners = len(log._listeners)
+    yield
+    while len(log._listeners) > listeners:
+        log._listeners.pop().stop()
+    for logger, handlers in saved_handlers:
+        logger.handlers = handlers
+    for handler, filters in saved_filters:
+        handler.filters = filters
+
+
+def test_logging_queue(restore_logging, monkeypatch):
+    records = []
+
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            records.append(self.format(record))
+
+    logger = logging.getLogger("operator_service.test_logging_queue")
+    logger.propagate = False
+    logger.addHandler(ListHandler())
+    log.set_module_levels("operator_service.test_logging_queue=DEBUG")
+    log.truncate_messages(4096)
+    log.move_handlers_to_queue()
+    assert isinstance(logger.handlers[0], logging.handlers.QueueHandler)
+
+    payload = {"data": "x" * 10000}
+    logger.debug("payload %s", payload)
+    payload["data"] = "changed"
+    logger.info("job %s", "1234")
+    listener = next(
+        listener
+        for listener in log._listeners
+        if isinstance(listener.handlers[0], ListHandler)
+    )
+    log._listeners.remove(listener)
+    listener.stop()
+
+    # a forked child has no listener thread, it starts new listeners
+    monkeypatch.setattr(log, "_listeners", [listener])
+    log._restart_listeners()
+    assert log._listeners[0] is not listener
+    logger.info("after fork")
+    log._listeners[0].stop()
+
+    assert records[0].startswith("payload {'data': 'xxx")
+    assert records[0].endswith("chars]")
+    assert len(records[0]) < 4200
+    assert records[1] == "job 1234"
+    assert records[2] == "after fork"
+
+
+def test_logging_truncates_without_queue(restore_logging, monkeypatch):
+    records = []
+
+    class ListHandler(logging.Handler):
+        def emit(self, record):
+            records.append(self.format(record))
+
+    logger = logging.getLogger("operator_service.test_logging_truncate")
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    for name in ("LOG_LEVEL", "LOG_CFG", "LOG_LEVELS"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("LOG_QUEUE", "0")
+    monkeypatch.setenv("LOG_MAX_MESSAGE_SIZE", "100")
+    log.setup_logging()
+    # set up twice, e.g. by the app and by gunicorn, filtered once
+    log.setup_logging()
+
+    assert logger.handlers == [handler]
+    assert len(handler.filters) == 1
+    logger.warning("payload %s", "x" * 1000)
+    assert records[0].startswith("payload xxx")
+    assert records[0].endswith("[truncated 908 chars]")
+
+
+def test_job_events(monkeypatch):
+    from operator_service import job_events
+
+    monkeypatch.setattr(job_events, "_start_listener", lambda: None)
+    monkeypatch.setenv("WATCH_KEEPALIVE", "0.01")
+    monkeypatch.setenv("WATCH_MAX_DURATION", "0.05")
+    monkeypatch.setenv("WATCH_QUEUE_SIZE", "2")
+
+    owner_events = job_events.subscribe(owner="owner1")
+    job_events_queue = job_events.subscribe(job_id="job2", owner="owner1")
+    other_events = job_events.subscribe(owner="owner2")
+    update = {"jobId": "job1", "owner": "owner1", "status": 40}
+    job_events.dispatch(json.dumps(update))
+    job_events.dispatch("not json")
+    assert owner_events.get_nowait() == update
+    assert job_events_queue.empty() and other_events.empty()
+
+    # a client which does not keep up gets a resync instead of its backlog
+    for status in range(3):
+        job_events.dispatch(json.dumps(dict(update, status=status)))
+    assert owner_events.get_nowait() is job_events.RESYNC
+    assert owner_events.empty()
+
+    statuses = [{"jobId": "job1", "status": 10}]
+    job_events.dispatch(json.dumps(update))
+    job_events._put(owner_events, job_events.RESYNC)
+    stream = "".join(job_events.stream_job_events(owner_events, lambda: statuses))
+    events = stream.split("\n\n")[:4]
+    assert [event.split("\n")[0] for event in events] == [
+        "event: status",
+        "event: update",
+        "event: status",
+        ": keepalive",
+    ]
+    assert json.loads(events[0].split("data: ")[1]) == statuses[0]
+    assert json.loads(events[1].split("data: ")[1]) == update
+    # the stream unsubscribes when it ends
+    assert owner_events not in job_events._subscribers
+    job_events.unsubscribe(job_events_queue)
+    job_events.unsubscribe(other_events)
+    assert not job_events._subscribers
+
+
+def test_encode_for_provider():
+    jobs = [{"jobId": "job1", "dateCreated": Decimal("1700000000.123456")}]
+    assert (
+        utils.encode_for_provider(jobs)
+        == '[{"jobId":"job1","dateCreated":"1700000000.123456"}]'
+    )
+    assert "".join(utils.stream_json_list(jobs)) == utils.encode_for_provider(jobs)
+    with pytest.raises(TypeError):
+        utils.encode_for_provider([object()])
+
+
+def test_json_codec():
+    # integers over 64 bits and non-ASCII text read and written as they are
+    document = '{"price":123456789012345678901234567890,"name":"caf\u00e9","size":1.5}'
+    obj = json_codec.loads(document)
+    assert obj == {"price": 123456789012345678901234567890, "name": "café", "size": 1.5}
+    assert (
+        json_codec.loads(document, parse_float=lambda t: str(float(t)))["size"] == "1.5"
+    )
+    assert (
+        json_codec.dumps(obj)
+        == '{"price":123456789012345678901234567890,"name":"café","size":1.5}'
+    )
+    assert json_codec.dumps(obj, ensure_ascii=True).isascii()
+    assert json.loads(json_codec.dumps(obj, ensure_ascii=True)) == obj
+    assert json_codec.loads('{"size":2.5}', parse_float=lambda t: str(float(t))) == {
+        "size": "2.5"
+    }
+    assert json_codec.dumps({"d": Decimal("1.10")}) == '{"d":"1.10"}'
+
+
+def test_nonce_check_fails_closed(monkeypatch):
+    monkeypatch.setattr(utils, "get_signer", lambda signature, message: "0xabc")
+    monkeypatch.setattr(utils, "get_nonce_for_certain_provider", lambda address: 2)
+
+    # database error, e.g. the nonces table has not been migrated yet
+    monkeypatch.setattr(
+        utils, "update_nonce_for_a_certain_provider", lambda nonce, address: None
+    )
+    msg, status, address = utils.process_provider_signature_validation(
+        "0xsignature", "owner", 1
+    )
+    assert status == 503
+    assert address is None
+
+    monkeypatch.setattr(
+        utils, "update_nonce_for_a_certain_provider", lambda nonce, address: False
+    )
+    with pytest.raises(InvalidSignatureError):
+        utils.process_provider_signature_validation("0xsignature", "owner", 1)
+
+    monkeypatch.setattr(
+        utils, "update_nonce_for_a_certain_provider", lambda nonce, address: True
+    )
+    assert utils.process_provider_signature_validation("0xsignature", "owner", 3) == (
+        "",
+        None,
+        "0xabc",
+    )
+
+
+def test_invalid_nonce_is_rejected(monkeypatch):
+    monkeypatch.setattr(utils, "get_signer", lambda signature, message: "0xabc")
+
+    def update_nonce(nonce, address):
+        raise AssertionError("invalid nonces must not reach Postgresql")
+
+    monkeypatch.setattr(utils, "update_nonce_for_a_certain_provider", update_nonce)
+    for nonce in (None, "None", "abc", "", "NaN", "Infinity"):
+        msg, status, address = utils.process_provider_signature_validation(
+            "0xsignature", "owner", nonce
+        )
+        assert status == 400
+        assert address is None
+
+    assert utils.is_valid_nonce("1700000000.123")
+    assert utils.is_valid_nonce(3)
+
+
+def test_green_psycopg(monkeypatch):
+    from gevent import monkey
+
+    callbacks = []
+    monkeypatch.setattr(green.extensions, "set_wait_callback", callbacks.append)
+    monkeypatch.setattr(monkey, "is_module_patched", lambda name: False)
+    assert green.patch_psycopg() is False
+    assert callbacks == []
+
+    # gevent workers patch the socket module before loading the app
+    monkeypatch.setattr(monkey, "is_module_patched", lambda name: name == "socket")
+    assert green.patch_psycopg() is True
+    assert callbacks == [green.gevent_wait_callback]
+
+
+def test_worker_connections(monkeypatch):
+    monkeypatch.delenv("OPERATOR_WORKER_CONNECTIONS", raising=False)
+    monkeypatch.setenv("POSTGRES_POOL_MAX", "10")
+    assert green.get_worker_connections() == 50
+
+    monkeypatch.setenv("OPERATOR_WORKER_CONNECTIONS", "20")
+    assert green.get_worker_connections() == 20
+    # more requests than the pool serves within POSTGRES_POOL_TIMEOUT
+    monkeypatch.setenv("OPERATOR_WORKER_CONNECTIONS", "1000")
+    assert green.get_worker_connections() == 50
+    monkeypatch.setenv("POSTGRES_POOL_MAX", "200")
+    assert green.get_worker_connections() == 1000